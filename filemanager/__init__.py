@@ -1,18 +1,66 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.conf import settings as django_settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_vary_headers
 from django import forms
-from PIL import Image
 from . import settings
-import mimetypes
+from .archives import archive_response
+from .downloads import file_response
+from .extract import ArchiveRejected, check_archive, extract
+from .conditional import (
+    accepts, etag_matches, gzip_response, make_etag, not_modified, not_modified_response, set_validators,
+)
+from .ledger import measure
+from .fileops import copy, move, same_device
+from .jobs import Job, job_queue
+from .listing import SORT_KEYS, list_directory
+from .metrics import Timings, record_action, record_state
+from .mime import detect_type, guess_type
+from .resumable import OffsetMismatch, UploadSession, expire_sessions
+from .state import get_state
+from .uploads import reserve_name, save_chunks, type_allowed
+from .thumbnails import (
+    FORMAT_COOKIE, ORIGINAL_FORMAT, OUTPUT_FORMATS, can_encode, get_icon,
+    thumbnail_format, thumbnail_pool,
+)
+from .tree import encode_tree, script_json
+import itertools
+import json
 import os
 import shutil
 import re
-import tarfile
+import timeit
 import zipfile
-import magic
 
 path_end = r'(?P<path>[\w\d_ -/.]*)$'
 
+# compiled once for the validation of names and paths
+parent_ref = re.compile(r'\.\.')
+file_name_chars = re.compile(r'[\w\d_ -/.]+')
+folder_name_chars = re.compile(r'[\w\d_ -]+')
+new_file_name_chars = re.compile(r'[\w\d_ -.]+')
+path_chars = re.compile(r'[\w\d_ -/]+')
+optional_path_chars = re.compile(r'[\w\d_ -/]*')
+
+
+def full_match(pattern, text):
+    """Whether ``pattern`` matches the whole of ``text``."""
+    match = pattern.match(text)
+    return match is not None and match.group(0) == text
+
+
+# query string flags selecting an endpoint instead of the page, in order
+ENDPOINTS = (
+    'download',
+    'job',
+    'tree',
+    'upload',
+    'search',
+    'list',
+    'action',
+    'quickupload',
+)
+
 ActionChoices = (
     ('upload', 'upload'),
     ('rename', 'rename'),
@@ -60,41 +108,146 @@ class FileManager(object):
         self.maxfilesize = maxfilesize
         self.extensions = extensions
         self.public_url_base = public_url_base
+        # the ledger and the search index are shared by the instances of
+        # the same basepath and extensions, see state.py
+        self.state = get_state(self.basepath, extensions)
+        self.usage = self.state.usage
+        self.search_index = self.state.search_index
+        self.generation = self.state.generation
+        self.jobs = []
+        self.timings = Timings()
+        self.action_stats = {'bytes': 0, 'files': 0, 'job': False}
 
-    def rename_if_exists(self, folder, file):
-        if folder[-1] != os.sep:
-            folder = folder + os.sep
-        if os.path.exists(folder + file):
-            if file.find('.') == -1:
-                # no extension
-                for i in range(1000):
-                    if not os.path.exists(folder + file + '.' + str(i)):
-                        break
-                return file + '.' + str(i)
-            else:
-                extension = file[file.rfind('.'):]
-                name = file[:file.rfind('.')]
-                for i in range(1000):
-                    full_path = folder + name + '.' + str(i) + extension
-                    if not os.path.exists(full_path):
-                        break
-                return name + '.' + str(i) + extension
-        else:
-            return file
+    def upload_error(self, name, size, space_used):
+        """
+        Why a file ``name`` of ``size`` bytes can't be uploaded when
+        ``space_used`` bytes are already used, or None if it can.
+        """
+        file_name_invalid = (
+            parent_ref.search(name)
+            or not full_match(file_name_chars, name)
+        )
+        if file_name_invalid:
+            return ("File name is not valid : " + name)
+        elif size > self.maxfilesize*1024:
+            return (
+                "File size exceeded "
+                + str(self.maxfilesize)
+                + " KB : "
+                + name
+            )
+        elif (
+                settings.FILEMANAGER_CHECK_SPACE and
+                (
+                    (space_used + size)
+                    > self.maxspace*1024
+                )
+        ):
+            return (
+                "Total Space size exceeded "
+                + str(self.maxspace)
+                + " KB : "
+                + name
+            )
+        elif (
+                self.extensions
+                and len(name.split('.')) > 1
+                and name.split('.')[-1] not in self.state.allowed_types.extensions
+        ):
+                return (
+                    "File extension not allowed (."
+                    + name.split('.')[-1]
+                    + ") : "
+                    + name
+                )
+        elif (
+                self.extensions
+                and len(name.split('.')) == 1
+                and name.split('.')[-1]
+                not in self.state.allowed_types.extensions
+        ):
+                return (
+                    "No file extension in uploaded file : "
+                    + name
+                )
+        return None
+
+    def save_upload(self, f, path, space_used):
+        """
+        Save the uploaded file ``f`` in the folder ``path``. Returns the
+        name it was saved under and None, or None and the error.
+        """
+        error = self.upload_error(f.name, f.size, space_used)
+        if error:
+            return None, error
+        filename = f.name.replace(' ', '_')  # replace spaces to prevent fs error
+        try:
+            # the type is checked on the first chunk, before anything is
+            # written
+            chunks = f.chunks()
+            first = next(chunks, b'')
+            if not type_allowed(first, self.extensions):
+                return None, "File type not allowed : " + f.name
+            filename = reserve_name(self.basepath + path, filename)
+            filepath = self.basepath + path + filename
+            try:
+                size = save_chunks(itertools.chain([first], chunks), filepath)
+            except Exception:
+                os.remove(filepath)
+                raise
+        finally:
+            f.close()
+        self.count(bytes=size, files=1)
+        self.update_usage(self.search_index.add(path + filename), bytes=size)
+        return filename, None
 
     def get_size(self, start_path):
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(start_path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-        return total_size
+        return measure(start_path)[0]
+
+    def update_usage(self, indexed, bytes=0, folders=0):
+        """
+        Count the change of an action in the usage ledger: ``indexed``, the
+        change the search index recorded, when it is built, else ``bytes``
+        and ``folders`` as measured by the action. A change the index
+        already knows was counted by the watcher.
+        """
+        if indexed is not None:
+            bytes, folders = indexed
+        self.usage.update(bytes=bytes, folders=folders)
+
+    def rebuild_usage(self):
+        """
+        Reconcile the usage ledger with the files actually on disk.
+        """
+        return self.usage.rebuild()
 
     def next_id(self):
         self.idee = self.idee + 1
         return self.idee
 
     def handle_form(self, form, files):
+        """
+        Perform the action of ``form`` and record its duration, bytes and
+        files; actions run through run_job() are recorded by their job.
+        """
+        self.action_stats = {'bytes': 0, 'files': 0, 'job': False}
+        start = timeit.default_timer()
+        messages = self.handle_action(form, files)
+        self.generation.bump()
+        if not self.action_stats['job']:
+            record_action(
+                form.cleaned_data['action'],
+                timeit.default_timer() - start,
+                self.action_stats['bytes'],
+                self.action_stats['files'],
+            )
+        return messages
+
+    def count(self, bytes=0, files=0):
+        self.action_stats['bytes'] += bytes
+        self.action_stats['files'] += files
+
+    def handle_action(self, form, files):
         action = form.cleaned_data['action']
         path = form.cleaned_data['path']
         name = form.cleaned_data['name']
@@ -105,7 +258,7 @@ class FileManager(object):
         invalid_folder_name = (
             name
             and file_or_dir == 'dir'
-            and not re.match(r'[\w\d_ -]+', name).group(0) == name
+            and not full_match(folder_name_chars, name)
         )
         if invalid_folder_name:
             messages.append("Invalid folder name : " + name)
@@ -115,97 +268,39 @@ class FileManager(object):
             name
             and file_or_dir == 'file'
             and (
-                re.search(r'\.\.', name)
-                or not re.match(r'[\w\d_ -.]+', name).group(0) == name
+                parent_ref.search(name)
+                or not full_match(new_file_name_chars, name)
             )
         )
         if invalid_file_name:
             messages.append("Invalid file name : " + name)
             return messages
 
-        invalid_path = not re.match(r'[\w\d_ -/]+', path).group(0) == path
+        invalid_path = not full_match(path_chars, path)
         if invalid_path:
             messages.append("Invalid path : " + path)
             return messages
+        # build the usage ledger before anything changes on disk, so that
+        # a concurrent rebuild can't count this action twice
+        self.usage.get()
         if action == 'upload':
+            space_used = self.usage.bytes
+            uploaded = 0
             for f in files.getlist('ufile'):
-                file_name_invalid = (
-                    re.search(r'\.\.', f.name)
-                    or not re.match(r'[\w\d_ -/.]+', f.name).group(0) == f.name
-                )
-                if file_name_invalid:
-                    messages.append("File name is not valid : " + f.name)
-                elif f.size > self.maxfilesize*1024:
-                    messages.append(
-                        "File size exceeded "
-                        + str(self.maxfilesize)
-                        + " KB : "
-                        + f.name
-                    )
-                elif (
-                        settings.FILEMANAGER_CHECK_SPACE and
-                        (
-                            (self.get_size(self.basepath) + f.size)
-                            > self.maxspace*1024
-                        )
-                ):
-                    messages.append(
-                        "Total Space size exceeded "
-                        + str(self.maxspace)
-                        + " KB : "
-                        + f.name
-                    )
-                elif (
-                        self.extensions
-                        and len(f.name.split('.')) > 1
-                        and f.name.split('.')[-1] not in self.extensions
-                ):
-                        messages.append(
-                            "File extension not allowed (."
-                            + f.name.split('.')[-1]
-                            + ") : "
-                            + f.name
-                        )
-                elif (
-                        self.extensions
-                        and len(f.name.split('.')) == 1
-                        and f.name.split('.')[-1]
-                        not in self.extensions
-                ):
-                        messages.append(
-                            "No file extension in uploaded file : "
-                            + f.name
-                        )
+                filename, error = self.save_upload(f, path, space_used + uploaded)
+                if error:
+                    messages.append(error)
                 else:
-                    filename = f.name.replace(' ', '_')  # replace spaces to prevent fs error
-                    filepath = (
-                        self.basepath
-                        + path
-                        + self.rename_if_exists(self.basepath + path, filename)
-                    )
-                    with open(filepath, 'wb') as dest:
-                        for chunk in f.chunks():
-                            dest.write(chunk)
-                    f.close()
-                    mimetype = magic.from_file(filepath, mime=True)
-                    guessed_exts = mimetypes.guess_all_extensions(mimetype)
-                    guessed_exts = [ext[1:] for ext in guessed_exts]
-                    common = [ext for ext in guessed_exts if ext in self.extensions]
-                    if not common:
-                        os.remove(filepath)
-                        messages.append(
-                            "File type not allowed : "
-                            + f.name
-                        )
+                    uploaded += f.size
             if len(messages) == 0:
                 messages.append('All files uploaded successfully')
         elif action == 'add':
-            os.chdir(self.basepath)
-            no_of_folders = len(list(os.walk('.')))
+            no_of_folders = self.usage.folders
             if (no_of_folders + 1) <= self.maxfolders:
                 try:
-                    os.chdir(self.basepath + path)
-                    os.mkdir(name)
+                    os.mkdir(os.path.join(self.basepath + path, name))
+                    self.update_usage(self.search_index.add(os.path.join(path, name)), folders=1)
+                    self.count(files=1)
                     messages.append('Folder created successfully : ' + name)
                 except OSError:
                     messages.append('Folder couldn\'t be created : ' + name)
@@ -221,8 +316,16 @@ class FileManager(object):
             oldname = path.split('/')[-2]
             path = '/'.join(path.split('/')[:-2])
             try:
-                os.chdir(self.basepath + path)
-                os.rename(oldname, name)
+                directory = self.basepath + path
+                os.rename(
+                    os.path.join(directory, oldname),
+                    os.path.join(directory, name),
+                )
+                self.update_usage(self.search_index.rename(
+                    os.path.join(path, oldname),
+                    os.path.join(path, name),
+                ))
+                self.count(files=1)
                 messages.append(
                     'Folder renamed successfully from '
                     + oldname
@@ -240,8 +343,15 @@ class FileManager(object):
                 name = path.split('/')[-2]
                 path = '/'.join(path.split('/')[:-2])
                 try:
-                    os.chdir(self.basepath + path)
-                    shutil.rmtree(name)
+                    dirpath = os.path.join(self.basepath + path, name)
+                    size, folders = measure(dirpath)
+                    shutil.rmtree(dirpath)
+                    self.update_usage(
+                        self.search_index.remove(os.path.join(path, name)),
+                        bytes=-size,
+                        folders=-folders,
+                    )
+                    self.count(bytes=size, files=1)
                     messages.append('Folder deleted successfully : ' + name)
                 except OSError:
                     messages.append('Folder couldn\'t deleted : ' + name)
@@ -258,8 +368,16 @@ class FileManager(object):
             if old_ext == new_ext:
                 path = '/'.join(path.split('/')[:-1])
                 try:
-                    os.chdir(self.basepath + path)
-                    os.rename(oldname, name)
+                    directory = self.basepath + path
+                    os.rename(
+                        os.path.join(directory, oldname),
+                        os.path.join(directory, name),
+                    )
+                    self.update_usage(self.search_index.rename(
+                        os.path.join(path, oldname),
+                        os.path.join(path, name),
+                    ))
+                    self.count(files=1)
                     messages.append(
                         'File renamed successfully from '
                         + oldname
@@ -288,8 +406,14 @@ class FileManager(object):
                 name = path.split('/')[-1]
                 path = '/'.join(path.split('/')[:-1])
                 try:
-                    os.chdir(self.basepath + path)
-                    os.remove(name)
+                    filepath = os.path.join(self.basepath + path, name)
+                    size = os.path.getsize(filepath)
+                    os.remove(filepath)
+                    self.update_usage(
+                        self.search_index.remove(os.path.join(path, name)),
+                        bytes=-size,
+                    )
+                    self.count(bytes=size, files=1)
                     messages.append('File deleted successfully : ' + name)
                 except OSError:
                     messages.append('File couldn\'t deleted : ' + name)
@@ -312,59 +436,511 @@ class FileManager(object):
                         + ' the destination folder.'
                     )
                 else:
-                    if action == 'move':
-                        method = shutil.move
-                    else:
-                        if file_or_dir == 'dir':
-                            method = shutil.copytree
-                        else:
-                            method = shutil.copy
+                    src = self.basepath + path
+                    destination = self.basepath + self.current_path
                     try:
-                        method(self.basepath + path, filename)
+                        if action == 'move' and same_device(src, destination):
+                            size = 0  # a rename
+                        else:
+                            size = measure(src)[0]
                     except OSError:
                         messages.append(
                             'File/folder couldn\'t be moved/copied.'
                         )
-                    except Exception as e:
-                        messages.append('Unexpected error : ' + e)
+                    else:
+                        messages = self.run_job(
+                            action,
+                            lambda job: self.transfer(action, src, filename, job),
+                            size,
+                        )
         elif action == 'unzip':
             if file_or_dir == 'dir':
                 messages.append('Cannot unzip a directory')
             else:
+                path = os.path.normpath(path)  # strip trailing slash if any
+                filename = (
+                    self.basepath
+                    + self.current_path
+                    + os.path.basename(path)
+                )
+                directory = self.basepath + self.current_path
+                zip_ref = None
                 try:
-                    path = os.path.normpath(path)  # strip trailing slash if any
-                    filename = (
-                        self.basepath
-                        + self.current_path
-                        + os.path.basename(path)
-                    )
                     zip_ref = zipfile.ZipFile(filename, 'r')
-                    # zip_ref.extractall(self.basepath + self.current_path)
-                    directory = self.basepath + self.current_path
-                    for file in zip_ref.namelist():
-                        if file.endswith(tuple(self.extensions)):
-                            zip_ref.extract(file, directory)
-                            mimetype = magic.from_file(directory + file, mime=True)
-                            print(directory + file)
-                            guessed_exts = mimetypes.guess_all_extensions(mimetype)
-                            guessed_exts = [ext[1:] for ext in guessed_exts]
-                            common = [ext for ext in guessed_exts if ext in self.extensions]
-                            if not common:
-                                os.remove(directory+file)
-                                messages.append(
-                                    "File in the zip is not allowed : "
-                                    + file
-                                )
+                    size = check_archive(
+                        zip_ref.infolist(),
+                        self.unzip_max_size(),
+                        settings.FILEMANAGER_UNZIP_MAX_RATIO,
+                    )
+                except ArchiveRejected as e:
                     zip_ref.close()
-                except Exception as e:
-                    print(e)
+                    messages.append(
+                        'ERROR : ' + os.path.basename(path) + ' was rejected, ' + str(e)
+                    )
+                except Exception:
+                    if zip_ref is not None:
+                        zip_ref.close()
                     messages.append('ERROR : Could not unzip the file.')
-                if len(messages) == 0:
-                    messages.append('Extraction completed successfully.')
+                else:
+                    messages = self.run_job(
+                        action,
+                        lambda job: self.unzip(zip_ref, directory, job),
+                        size,
+                        len(zip_ref.infolist()),
+                    )
 
         return messages
 
+    def resumable_upload(self, request):
+        """
+        Upload a file in several requests, resuming after a failed one:
+
+        - POST ``?upload`` with ``name``, ``size`` and ``path`` (the target
+          folder) creates the upload, once the checks of the upload action
+          pass, and returns its ``id``
+        - PATCH ``?upload=<id>`` with an ``Upload-Offset`` header appends
+          the request body at that offset
+        - GET ``?upload=<id>`` returns the offset to resume from
+        - POST ``?upload=<id>&finalize`` checks the type of the complete
+          file and moves it into its folder
+        - DELETE ``?upload=<id>`` aborts the upload
+        """
+        upload_id = request.GET['upload']
+        if not upload_id:
+            if request.method != 'POST':
+                return JsonResponse({'error': 'Method not allowed'}, status=405)
+            return self.create_upload(request)
+        session = UploadSession.load(self.basepath, upload_id)
+        if session is None:
+            return JsonResponse({'error': 'Unknown upload'}, status=404)
+        if request.method in ('GET', 'HEAD'):
+            response = JsonResponse({
+                'id': session.id,
+                'offset': session.offset,
+                'size': session.size,
+            })
+        elif request.method == 'PATCH':
+            try:
+                offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            except (KeyError, ValueError):
+                return JsonResponse({'error': 'Missing Upload-Offset'}, status=400)
+            try:
+                offset = session.append(offset, request)
+            except OffsetMismatch as e:
+                response = JsonResponse({'error': str(e), 'offset': e.offset}, status=409)
+                response['Upload-Offset'] = str(e.offset)
+                return response
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=413)
+            response = JsonResponse({'id': session.id, 'offset': offset})
+        elif request.method == 'POST' and 'finalize' in request.GET:
+            return self.finalize_upload(session)
+        elif request.method == 'DELETE':
+            session.delete()
+            return HttpResponse(status=204)
+        else:
+            return JsonResponse({'error': 'Method not allowed'}, status=405)
+        response['Upload-Offset'] = str(session.offset)
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    def create_upload(self, request):
+        expire_sessions(self.basepath, settings.FILEMANAGER_UPLOAD_EXPIRY)
+        name = request.POST.get('name', '')
+        path = request.POST.get('path', '/')
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid size'}, status=400)
+        invalid_path = (
+            not path.startswith('/')
+            or not path.endswith('/')
+            or parent_ref.search(path)
+            or not full_match(path_chars, path)
+            or not os.path.isdir(self.basepath + path)
+        )
+        if invalid_path:
+            return JsonResponse({'error': 'Invalid path : ' + path}, status=400)
+        if not name or size < 0:
+            error = 'File name is not valid : ' + name
+        else:
+            error = self.upload_error(name, size, self.usage.bytes)
+        if error:
+            return JsonResponse({'error': error}, status=400)
+        session = UploadSession.create(self.basepath, name, path, size)
+        response = JsonResponse({'id': session.id, 'offset': 0}, status=201)
+        response['Location'] = '?upload=' + session.id
+        response['Upload-Offset'] = '0'
+        return response
+
+    def finalize_upload(self, session):
+        if not session.complete:
+            response = JsonResponse(
+                {'error': 'Upload is not complete', 'offset': session.offset},
+                status=409,
+            )
+            response['Upload-Offset'] = str(session.offset)
+            return response
+        # the quota may have been used up by others since the upload began
+        self.usage.get()
+        error = self.upload_error(session.name, session.size, self.usage.bytes)
+        if not error and not type_allowed(session.first_chunk(), self.extensions):
+            error = 'File type not allowed : ' + session.name
+        if error:
+            session.delete()
+            return JsonResponse({'messages': [error]}, status=400)
+        directory = self.basepath + session.path
+        filename = session.name.replace(' ', '_')  # replace spaces to prevent fs error
+        filename = reserve_name(directory, filename)
+        try:
+            session.finish(directory + filename)
+        except OSError:
+            os.remove(directory + filename)
+            raise
+        self.update_usage(self.search_index.add(session.path + filename), bytes=session.size)
+        self.generation.bump()
+        return JsonResponse({'messages': ['All files uploaded successfully']})
+
+    def changed_folders(self, form):
+        """
+        The folders whose content the action of ``form`` changes.
+        """
+        action = form.cleaned_data['action']
+        path = form.cleaned_data['path'] or '/'
+        current_path = form.cleaned_data['current_path'] or '/'
+        parent = os.path.dirname(path.rstrip('/'))
+        parent = parent.rstrip('/') + '/'
+        if action in ('upload', 'add'):
+            folders = [path]
+        elif action in ('rename', 'delete'):
+            folders = [parent]
+        elif action == 'move':
+            folders = [parent, current_path]
+        else:
+            folders = [current_path]
+        return sorted(set(folders))
+
+    def action_api(self, request):
+        """
+        Perform an action like a POST of the page but answer with JSON: the
+        messages and, for each folder the action changed, its new content
+        as tree() returns it. Folders changed by background jobs are only
+        listed in ``changed``, to be fetched once the jobs are done.
+        """
+        if request.method != 'POST':
+            return JsonResponse({'error': 'Method not allowed'}, status=405)
+        form = FileManagerForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return JsonResponse({'error': 'Invalid form', 'fields': form.errors}, status=400)
+        messages = self.handle_form(form, request.FILES)
+        changed = self.changed_folders(form)
+        delta = []
+        if not self.jobs:
+            for folder in changed:
+                node = self.tree_node(folder, request)
+                if node is not None:
+                    node['path'] = folder
+                    # unzip can also add to the folders inside
+                    node['deep'] = form.cleaned_data['action'] == 'unzip'
+                    delta.append(node)
+        return JsonResponse({
+            'messages': list(map(str, messages)),
+            'delta': delta,
+            'changed': changed,
+            'jobs': self.jobs,
+            'space_consumed': self.usage.bytes if settings.FILEMANAGER_CHECK_SPACE else 0,
+        })
+
+    def quick_upload(self, request):
+        """
+        Upload endpoint for CKEditor's filebrowserUploadUrl: saves the
+        ``upload`` file in FILEMANAGER_QUICK_UPLOAD_PATH and answers the
+        way the editor asked, with JSON (``responseType=json``) or with a
+        script calling back CKEDITOR.
+        """
+        f = request.FILES.get('upload')
+        path = settings.FILEMANAGER_QUICK_UPLOAD_PATH
+        if request.method != 'POST' or f is None:
+            filename, error = None, 'No file uploaded'
+        elif not os.path.isdir(self.basepath + path):
+            filename, error = None, 'Upload folder does not exist : ' + path
+        else:
+            self.usage.get()
+            filename, error = self.save_upload(f, path, self.usage.bytes)
+            if not error:
+                self.generation.bump()
+        url = self.ckeditor_baseurl + path + (filename or '')
+        if request.GET.get('responseType') == 'json':
+            if error:
+                return JsonResponse({'uploaded': 0, 'error': {'message': error}})
+            return JsonResponse({'uploaded': 1, 'fileName': filename, 'url': url})
+        arguments = [request.GET.get('CKEditorFuncNum', ''), '' if error else url, error or '']
+        return HttpResponse(
+            '<script type="text/javascript">'
+            'window.parent.CKEDITOR.tools.callFunction(%s);'
+            '</script>'
+            % ', '.join(json.dumps(a).replace('<', '\\u003c') for a in arguments)
+        )
+
+    def run_job(self, action, work, bytes_total=0, files_total=0):
+        """
+        Run ``work(job)`` inline, or on the job queue when it involves more
+        than FILEMANAGER_JOB_THRESHOLD bytes. Returns the messages to show.
+        """
+        def timed_work(job):
+            start = timeit.default_timer()
+            messages = work(job)
+            self.generation.bump()
+            record_action(
+                action,
+                timeit.default_timer() - start,
+                job.bytes_done,
+                job.files_done,
+            )
+            return messages
+
+        self.action_stats['job'] = True
+        job = Job(self.basepath, action, timed_work, bytes_total, files_total)
+        threshold = settings.FILEMANAGER_JOB_THRESHOLD
+        if threshold is None or bytes_total < threshold:
+            return job.run()
+        job_queue().submit(job)
+        self.jobs.append(job.id)
+        return ['Running in the background : ' + action]
+
+    def transfer(self, action, src, dst, job):
+        try:
+            if action == 'move':
+                move(src, dst, job.progress)
+                self.update_usage(self.search_index.rename(
+                    src[len(self.basepath):],
+                    dst[len(self.basepath):],
+                ))
+            else:
+                size, folders = copy(src, dst, job.progress)
+                self.update_usage(
+                    self.search_index.add(dst[len(self.basepath):]),
+                    bytes=size,
+                    folders=folders,
+                )
+        except OSError:
+            return ['File/folder couldn\'t be moved/copied.']
+        return []
+
+    def unzip_max_size(self):
+        """
+        Most bytes an archive may expand to.
+        """
+        limits = []
+        if settings.FILEMANAGER_UNZIP_MAX_SIZE is not None:
+            limits.append(settings.FILEMANAGER_UNZIP_MAX_SIZE)
+        if settings.FILEMANAGER_CHECK_SPACE:
+            limits.append(max(0, self.maxspace*1024 - self.usage.bytes))
+        return min(limits) if limits else None
+
+    def unzip(self, zip_ref, directory, job):
+        try:
+            report = extract(
+                zip_ref,
+                directory,
+                self.extensions,
+                self.unzip_max_size(),
+                settings.FILEMANAGER_UNZIP_MAX_RATIO,
+                settings.FILEMANAGER_UNZIP_WORKERS,
+                job.progress,
+            )
+        except ArchiveRejected as e:
+            return [
+                'ERROR : ' + os.path.basename(zip_ref.filename)
+                + ' was rejected, ' + str(e)
+            ]
+        except Exception:
+            return ['ERROR : Could not unzip the file.']
+        self.update_usage(
+            self.search_index.add(*[
+                os.path.join(directory[len(self.basepath):], name)
+                for name in report.extracted
+            ]),
+            bytes=report.bytes,
+            folders=report.folders,
+        )
+        return report.messages()
+
+    def job_status(self, job_id):
+        job = job_queue().get(job_id)
+        if job is None or job.basepath != self.basepath:
+            return JsonResponse({'error': 'Unknown job'}, status=404)
+        return JsonResponse(job.as_dict())
+
+    def list_directory(self, path):
+        """
+        Return ``(dirs, files)`` directly inside ``path`` (relative to
+        basepath), without descending any further.
+        """
+        try:
+            listing = list_directory(self.basepath + path)
+        except OSError:
+            return [], []
+        return list(listing.dirs), list(listing.files)
+
+    def add_files(self, node, files):
+        """
+        Put ``files`` in a tree node, unless there are more than
+        FILEMANAGER_LIST_PAGE_SIZE of them: the node is then marked 'paged'
+        and the page fetches them one page at a time with list_page().
+        """
+        page_size = settings.FILEMANAGER_LIST_PAGE_SIZE
+        if page_size and len(files) > page_size:
+            node['files'] = []
+            node['paged'] = 'yes'
+        else:
+            node['files'] = list(files)
+
+    def lazy_directory_structure(self):
+        """
+        Like directory_structure but only the root and the folders on the
+        way to current_path are listed. The other folders are sent with
+        'loaded': 'no' and fetched one level at a time through tree().
+        """
+        self.idee = 0
+        node = {'id': self.next_id(), 'open': 'yes', 'dirs': {}, 'files': []}
+        dir_structure = {'': node}
+        path = '/'
+        parts = [d for d in self.current_path.split('/') if d]
+        while True:
+            directories, files = self.list_directory(path)
+            self.add_files(node, files)
+            for d in directories:
+                node['dirs'][d] = {
+                    'id': self.next_id(),
+                    'open': 'no',
+                    'loaded': 'no',
+                    'dirs': {},
+                    'files': [],
+                }
+            if path == self.current_path:
+                self.current_id = node['id']
+            if not parts or parts[0] not in node['dirs']:
+                break
+            node = node['dirs'][parts[0]]
+            node['open'] = 'yes'
+            del node['loaded']
+            path = path + parts.pop(0) + '/'
+        return dir_structure
+
+    def tree_node(self, path, request=None):
+        """
+        The folders and files directly inside the folder ``path``, or None
+        if it is not a valid folder.
+        """
+        path = '/' + path.strip('/')
+        if path != '/':
+            path = path + '/'
+        invalid_path = (
+            parent_ref.search(path)
+            or not full_match(optional_path_chars, path)
+            or not os.path.isdir(self.basepath + path)
+        )
+        if invalid_path:
+            return None
+        directories, files = self.list_directory(path)
+        data = {'dirs': directories}
+        self.add_files(data, files)
+        if 'paged' not in data:
+            self.prefetch_thumbnails(path, request=request)
+        return data
+
+    def tree(self, path, request=None):
+        """
+        JSON listing of a single folder for the lazily loaded tree.
+        """
+        data = self.tree_node(path, request)
+        if data is None:
+            return JsonResponse({'error': 'Invalid path'}, status=400)
+        return JsonResponse(data)
+
+    def search(self, request):
+        """
+        JSON page of the files and folders matching ``?search=``, see
+        SearchIndex.search() for the other parameters.
+        """
+        try:
+            limit = int(request.GET.get('limit', 50))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid limit'}, status=400)
+        results, after = self.search_index.search(
+            request.GET['search'],
+            request.GET.get('mode', 'substring'),
+            request.GET.get('ext'),
+            request.GET.get('after'),
+            limit,
+        )
+        return JsonResponse({'results': results, 'next': after})
+
+    def list_page(self, path, request):
+        """
+        JSON page of the entries of the folder ``path``, with their size,
+        mtime and mimetype. ``?sort=`` is name, size or mtime, ``&desc``
+        reverses it, ``&ext=`` only keeps the files with that extension and
+        ``&after=`` is the ``next`` value of the previous page.
+        """
+        path = '/' + path.strip('/')
+        if path != '/':
+            path = path + '/'
+        sort = request.GET.get('sort', 'name')
+        invalid = (
+            parent_ref.search(path)
+            or not full_match(optional_path_chars, path)
+            or sort not in SORT_KEYS
+        )
+        if invalid:
+            return JsonResponse({'error': 'Invalid path'}, status=400)
+        try:
+            limit = int(request.GET.get('limit', settings.FILEMANAGER_LIST_PAGE_SIZE or 100))
+            after = request.GET.get('after')
+            if after is not None:
+                after = tuple(json.loads(after))
+            entries, next_key = list_directory(self.basepath + path).page(
+                sort,
+                'desc' in request.GET,
+                request.GET.get('ext'),
+                after,
+                max(1, min(limit, 1000)),
+            )
+        except (ValueError, TypeError):
+            return JsonResponse({'error': 'Invalid parameters'}, status=400)
+        except OSError:
+            return JsonResponse({'error': 'Invalid path'}, status=400)
+        self.prefetch_thumbnails(path, entries, request)
+        rows = []
+        for e in entries:
+            row = {
+                'name': e.name,
+                'is_dir': e.is_dir,
+                'size': e.size,
+                'mtime': e.mtime,
+                'mimetype': None,
+            }
+            if not e.is_dir:
+                filepath = self.basepath + path + e.name
+                # the listing stays cached while a file is rewritten in
+                # place, which does not change the mtime of its folder
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    st = None
+                else:
+                    row['size'], row['mtime'] = st.st_size, st.st_mtime
+                row['mimetype'] = detect_type(filepath, st)
+            rows.append(row)
+        return JsonResponse({
+            'entries': rows,
+            'next': json.dumps(next_key) if next_key else None,
+        })
+
     def directory_structure(self):
+        if settings.FILEMANAGER_LAZY_TREE:
+            return self.lazy_directory_structure()
         self.idee = 0
         dir_structure = {
             '': {
@@ -374,137 +950,290 @@ class FileManager(object):
                 'files': [],
             },
         }
-        os.chdir(self.basepath)
-        for directory, directories, files in os.walk('.'):
-            directory_list = directory[1:].split('/')
-            current_dir = None
-            nextdirs = dir_structure
-            for d in directory_list:
-                current_dir = nextdirs[d]
-                nextdirs = current_dir['dirs']
-            if directory[1:] + '/' == self.current_path:
+        stack = [('/', dir_structure[''])]
+        while stack:
+            path, current_dir = stack.pop()
+            if path == self.current_path:
                 self.current_id = current_dir['id']
-            current_dir['dirs'].update(
-                dict(
-                    map(
-                        lambda d: (
-                            d,
-                            {
-                                'id': self.next_id(),
-                                'open': 'no',
-                                'dirs': {},
-                                'files': [],
-                            }
-                        ),
-                        directories,
-                    )
-                )
-            )
-            current_dir['files'] = files
+            try:
+                listing = list_directory(self.basepath + path)
+            except OSError:
+                continue
+            subdirs = []
+            for d in listing.dirs:
+                current_dir['dirs'][d] = {
+                    'id': self.next_id(),
+                    'open': 'no',
+                    'dirs': {},
+                    'files': [],
+                }
+                if d not in listing.links:
+                    subdirs.append((path + d + '/', current_dir['dirs'][d]))
+            self.add_files(current_dir, listing.files)
+            stack.extend(reversed(subdirs))
         return dir_structure
 
-    def media(self, path):
-        ext = path.split('.')[-1]
-        try:
-            mimetypes.init()
-            mimetype = mimetypes.guess_type(path)[0]
-            img = Image.open(self.basepath + '/' + path)
-            width, height = img.size
-            mx = max([width, height])
-            w, h = width, height
-            if mx > 60:
-                w = width*60/mx
-                h = height*60/mx
-            img = img.resize((w, h), Image.ANTIALIAS)
-            response = HttpResponse(content_type=mimetype or "image/" + ext)
-            response['Cache-Control'] = 'max-age=3600'
-            img.save(
-                response,
-                mimetype.split('/')[1] if mimetype else ext.upper()
-            )
-            return response
-        except Exception:
-            imagepath = (
-                settings.FILEMANAGER_STATIC_ROOT
-                + 'images/icons/'
-                + ext
-                + '.png'
+    def thumbnail_variant(self, mimetype, ext, request=None, query=None):
+        """
+        The format, size and quality of the thumbnail ``request`` asks for:
+        the ``?size=`` preset and the ``?format=`` of ``query`` (its query
+        string by default, 'original' for the format of the image), else
+        the first of FILEMANAGER_THUMBNAIL_FORMATS named by its Accept
+        header, else the format of the image. Raises ValueError for an
+        unknown size or format.
+        """
+        if query is None:
+            query = request.GET if request is not None else {}
+        preset = query.get('size', settings.FILEMANAGER_THUMBNAIL_PRESET)
+        if preset not in settings.FILEMANAGER_THUMBNAIL_PRESETS:
+            raise ValueError('Invalid size')
+        format = query.get('format')
+        if format == ORIGINAL_FORMAT:
+            format = thumbnail_format(mimetype, ext)
+        elif format is not None:
+            if format not in OUTPUT_FORMATS or not can_encode(format):
+                raise ValueError('Invalid format')
+        else:
+            format = next(
+                (
+                    f for f in settings.FILEMANAGER_THUMBNAIL_FORMATS
+                    if can_encode(f) and accepts(request, 'image/' + f)
+                ),
+                thumbnail_format(mimetype, ext),
             )
-            if not os.path.exists(imagepath):
-                imagepath = (
-                    settings.FILEMANAGER_STATIC_ROOT
-                    + 'images/icons/default.png'
+        return (
+            format,
+            settings.FILEMANAGER_THUMBNAIL_PRESETS[preset],
+            settings.FILEMANAGER_THUMBNAIL_QUALITY.get(format.lower()),
+        )
+
+    def thumbnail_key(self, filepath, mtime, size, variant):
+        return make_etag(os.path.abspath(filepath), mtime, size, *variant)
+
+    def prefetch_thumbnails(self, path, entries=None, request=None):
+        """
+        Start making the thumbnails of the images among the listing
+        ``entries`` (all of them by default) of the folder ``path``, before
+        the page asks for them. They are made in the default size and in
+        the format script.js asks them in, kept in a cookie, or before it
+        ran in the format the Accept header of ``request`` allows. The
+        listings are fetched with XHRs whose Accept header says nothing
+        about images.
+        """
+        if not settings.FILEMANAGER_THUMBNAIL_PREFETCH:
+            return
+        query = {}
+        if request is not None and FORMAT_COOKIE in request.COOKIES:
+            query['format'] = request.COOKIES[FORMAT_COOKIE]
+        if entries is None:
+            try:
+                entries = list_directory(self.basepath + path).entries
+            except OSError:
+                return
+        pool = thumbnail_pool()
+        for entry in entries:
+            if entry.is_dir:
+                continue
+            mimetype = guess_type(entry.name)
+            if mimetype and mimetype.startswith('image/'):
+                filepath = self.basepath + path + entry.name
+                # not the size and mtime of the listing, which may be cached
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                try:
+                    variant = self.thumbnail_variant(
+                        mimetype, entry.name.split('.')[-1], request, query,
+                    )
+                except ValueError:
+                    return
+                pool.prefetch(
+                    self.thumbnail_key(filepath, st.st_mtime, st.st_size, variant).strip('"'),
+                    filepath,
+                    *variant
                 )
-            img = Image.open(imagepath)
-            width, height = img.size
-            mx = max([width, height])
-            w, h = width, height
-            if mx > 60:
-                w = int(width*60/mx)
-                h = int(height*60/mx)
-            img = img.resize((w, h), Image.ANTIALIAS)
-            response = HttpResponse(content_type="image/png")
-            response['Cache-Control'] = 'max-age:3600'
-            img.save(response, 'png')
-            return response
 
-    def download(self, path, file_or_dir):
-        if not re.match(r'[\w\d_ -/]*', path).group(0) == path:
+    def media(self, path, request=None):
+        ext = path.split('.')[-1]
+        mimetype = guess_type(path)
+        if mimetype is None:
+            # no known extension, look at the content
+            mimetype = detect_type(self.basepath + '/' + path)
+        if mimetype and mimetype.startswith('image/'):
+            try:
+                variant = self.thumbnail_variant(mimetype, ext, request)
+            except ValueError as e:
+                return HttpResponse(str(e), status=400)
+            format = variant[0]
+            if format != thumbnail_format(mimetype, ext):
+                mimetype = 'image/' + format
+            try:
+                filepath = self.basepath + '/' + path
+                st = os.stat(filepath)
+                etag = self.thumbnail_key(filepath, st.st_mtime, st.st_size, variant)
+                if not_modified(request, etag, st.st_mtime):
+                    response = not_modified_response(etag, st.st_mtime)
+                else:
+                    data = thumbnail_pool().get(etag.strip('"'), filepath, *variant)
+                    response = HttpResponse(data, content_type=mimetype)
+                    response['Cache-Control'] = 'max-age=3600'
+                    set_validators(response, etag, st.st_mtime)
+                # the format depends on the Accept header
+                patch_vary_headers(response, ('Accept',))
+                return response
+            except Exception:
+                pass
+        icon = get_icon(ext)
+        if not_modified(request, icon.etag, icon.mtime):
+            return not_modified_response(icon.etag, icon.mtime)
+        response = HttpResponse(icon.data, content_type="image/png")
+        response['Cache-Control'] = 'max-age=3600'
+        return set_validators(response, icon.etag, icon.mtime)
+
+    def download(self, path, file_or_dir, request=None):
+        invalid_path = (
+            parent_ref.search(path)
+            or not full_match(optional_path_chars, path)
+        )
+        if invalid_path:
             return HttpResponse('Invalid path')
         if file_or_dir == 'file':
             filepath = self.basepath + '/' + path
-            with open(filepath, 'rb') as f:
-                response = HttpResponse(
-                    f.read(),
-                    content_type=mimetypes.guess_type(filepath)[0],
+            return file_response(request, filepath, path.split('/')[-1])
+        elif file_or_dir in ('dir', 'archive'):
+            if file_or_dir == 'dir':
+                paths = [path]
+                name = (self.basepath + '/' + path).split('/')[-2] or 'root'
+            else:
+                # several files and folders selected with ?path=...
+                paths = request.GET.getlist('path') if request else []
+                name = 'download'
+            for p in paths:
+                invalid_path = (
+                    parent_ref.search(p)
+                    or not full_match(optional_path_chars, p)
+                    or not os.path.exists(self.basepath + '/' + p)
                 )
-            response['Content-Length'] = os.path.getsize(filepath)
-            response['Content-Disposition'] = (
-                'attachment; filename=' + path.split('/')[-1]
+                if invalid_path:
+                    return HttpResponse('Invalid path')
+            if not paths:
+                return HttpResponse('Invalid path')
+            archive_format = settings.FILEMANAGER_ARCHIVE_FORMAT
+            if request:
+                archive_format = request.GET.get('format', archive_format)
+            return archive_response(
+                [os.path.normpath(self.basepath + '/' + p) for p in paths],
+                name,
+                archive_format,
+                settings.FILEMANAGER_ARCHIVE_COMPRESSLEVEL,
             )
-            return response
-        elif file_or_dir == 'dir':
-            dirpath = self.basepath + '/' + path
-            dirname = dirpath.split('/')[-2]
-            response = HttpResponse(content_type='application/x-gzip')
-            response['Content-Disposition'] = (
-                'attachment; filename=%s.tar.gz'
-                % dirname
-            )
-            tarred = tarfile.open(fileobj=response, mode='w:gz')
-            tarred.add(dirpath, arcname=dirname)
-            tarred.close()
-            return response
 
     def render(self, request, path):
-        if 'download' in request.GET:
-            return self.download(path, request.GET['download'])
-        if path:
-            return self.media(path)
+        self.timings = Timings()
+        with self.timings.phase('total'):
+            response = self.dispatch(request, path)
+        return self.finish_response(response)
+
+    def finish_response(self, response):
+        record_state()
+        if settings.FILEMANAGER_SERVER_TIMING:
+            response['Server-Timing'] = self.timings.server_timing()
+        return response
+
+    def endpoint(self, request, path):
+        """
+        What ``request`` asks for: the first of ENDPOINTS in its query
+        string, else 'media' for a file path, else 'page'.
+        """
+        for name in ENDPOINTS:
+            if name in request.GET:
+                return name
+        return 'media' if path else 'page'
+
+    def dispatch(self, request, path):
+        endpoints = {
+            'download': lambda: self.download(path, request.GET['download'], request),
+            'job': lambda: self.job_status(request.GET['job']),
+            'tree': lambda: gzip_response(request, self.tree(path, request)),
+            'upload': lambda: self.resumable_upload(request),
+            'search': lambda: self.search(request),
+            'list': lambda: gzip_response(request, self.list_page(path, request)),
+            'action': lambda: self.action_api(request),
+            'quickupload': lambda: self.quick_upload(request),
+            'media': lambda: self.media(path, request),
+        }
+        name = self.endpoint(request, path)
+        if name in endpoints:
+            with self.timings.phase(name):
+                return endpoints[name]()
         CKEditorFuncNum = request.GET.get('CKEditorFuncNum', '')
+        etag = None
+        if request.method != 'POST' and settings.FILEMANAGER_PAGE_ETAG:
+            etag = self.page_etag(request)
+            if etag_matches(request, etag):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
         messages = []
         self.current_path = '/'
         self.current_id = 1
         if request.method == 'POST':
             form = FileManagerForm(request.POST, request.FILES)
             if form.is_valid():
-                messages = self.handle_form(form, request.FILES)
-        if settings.FILEMANAGER_CHECK_SPACE:
-                space_consumed = self.get_size(self.basepath)
-        else:
-                space_consumed = 0
-        return render(
-            request,
-            'filemanager/index.html',
-            {
-                'dir_structure': self.directory_structure(),
-                'messages': list(map(str, messages)),
-                'current_id': self.current_id,
-                'CKEditorFuncNum': CKEditorFuncNum,
-                'ckeditor_baseurl': self.ckeditor_baseurl,
-                'public_url_base': self.public_url_base,
-                'space_consumed': space_consumed,
-                'max_space': self.maxspace,
-                'show_space': settings.FILEMANAGER_SHOW_SPACE,
-            }
+                with self.timings.phase('action'):
+                    messages = self.handle_form(form, request.FILES)
+        with self.timings.phase('usage'):
+            if settings.FILEMANAGER_CHECK_SPACE:
+                    space_consumed = self.usage.bytes
+            else:
+                    space_consumed = 0
+        with self.timings.phase('tree'):
+            dir_structure = self.directory_structure()
+            self.prefetch_thumbnails(self.current_path, request=request)
+        with self.timings.phase('template'):
+            response = render(
+                request,
+                'filemanager/index.html',
+                {
+                    'tree': script_json(encode_tree(dir_structure)),
+                    'messages': list(map(str, messages)),
+                    'current_id': self.current_id,
+                    'CKEditorFuncNum': CKEditorFuncNum,
+                    'ckeditor_baseurl': self.ckeditor_baseurl,
+                    'public_url_base': self.public_url_base,
+                    'space_consumed': space_consumed,
+                    'max_space': self.maxspace,
+                    'show_space': settings.FILEMANAGER_SHOW_SPACE,
+                    'jobs': json.dumps(self.jobs),
+                    'upload_chunk_size': json.dumps(settings.FILEMANAGER_UPLOAD_CHUNK_SIZE),
+                    'list_page_size': json.dumps(settings.FILEMANAGER_LIST_PAGE_SIZE),
+                    'thumbnail_formats': json.dumps([
+                        f for f in settings.FILEMANAGER_THUMBNAIL_FORMATS if can_encode(f)
+                    ]),
+                }
+            )
+        if etag:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+            patch_vary_headers(response, ('Cookie',))
+        return gzip_response(request, response)
+
+    def page_etag(self, request):
+        """
+        ETag of the page: it changes with the tree generation, the
+        configuration, the query string and the session and CSRF cookies.
+        """
+        return make_etag(
+            self.generation.get(),
+            self.basepath,
+            request.get_full_path(),
+            request.COOKIES.get(django_settings.CSRF_COOKIE_NAME, ''),
+            request.COOKIES.get(django_settings.SESSION_COOKIE_NAME, ''),
+            self.ckeditor_baseurl,
+            self.public_url_base,
+            self.maxfolders,
+            self.maxspace,
+            self.maxfilesize,
+            self.extensions,
         )
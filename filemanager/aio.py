@@ -0,0 +1,108 @@
+"""
+Async views for ASGI servers (Django 3.1+, Python 3.6+). This module is
+not imported by the package, so the synchronous API keeps working on
+older versions.
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import FileManager, settings
+from .metrics import Timings
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def executor(name):
+    """
+    The bounded thread pool ``name``: 'io' for filesystem work, 'image' for
+    decoding and resizing images.
+    """
+    if name not in _executors:
+        with _executors_lock:
+            if name not in _executors:
+                if name == 'image':
+                    workers = settings.FILEMANAGER_ASYNC_IMAGE_WORKERS or os.cpu_count() or 1
+                else:
+                    workers = settings.FILEMANAGER_ASYNC_IO_WORKERS
+                _executors[name] = ThreadPoolExecutor(
+                    workers,
+                    thread_name_prefix='filemanager-' + name,
+                )
+    return _executors[name]
+
+
+async def run_in(name, func, *args, **kwargs):
+    """
+    Run ``func`` in the executor ``name`` without blocking the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor(name),
+        functools.partial(func, *args, **kwargs),
+    )
+
+
+async def iter_async(chunks):
+    """
+    Pull the chunks of a blocking iterator from the io executor.
+    """
+    iterator = iter(chunks)
+    done = object()
+    while True:
+        chunk = await run_in('io', next, iterator, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def stream_async(response):
+    """
+    Make a streaming response read its content off the event loop, with
+    Django 4.2+ which accepts asynchronous iterators. Before that, ASGI
+    servers iterate streaming responses in a thread anyway.
+    """
+    if response.streaming and hasattr(response, 'is_async'):
+        response.streaming_content = iter_async(response.streaming_content)
+    return response
+
+
+class AsyncFileManager(object):
+    """
+    Coroutine counterparts of the views of a FileManager, created with the
+    same arguments: the blocking filesystem work runs in the 'io' executor
+    and the thumbnails are made in the 'image' executor.
+
+    async def view(request, path):
+        fm = AsyncFileManager(settings.MEDIA_ROOT)
+        return await fm.render(request, path)
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.fm = FileManager(*args, **kwargs)
+
+    async def render(self, request, path):
+        name = self.fm.endpoint(request, path)
+        if name not in ('download', 'media'):
+            return await run_in('io', self.fm.render, request, path)
+        self.fm.timings = Timings()
+        with self.fm.timings.phase('total'):
+            with self.fm.timings.phase(name):
+                if name == 'download':
+                    response = await self.download(path, request.GET['download'], request)
+                else:
+                    response = await self.media(path, request)
+        return self.fm.finish_response(response)
+
+    async def media(self, path, request=None):
+        return await run_in('image', self.fm.media, path, request)
+
+    async def download(self, path, file_or_dir, request=None):
+        response = await run_in('io', self.fm.download, path, file_or_dir, request)
+        return stream_async(response)
+
+    async def handle_form(self, form, files):
+        return await run_in('io', self.fm.handle_form, form, files)
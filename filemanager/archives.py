@@ -0,0 +1,199 @@
+import gzip
+import os
+import stat
+import sys
+import tarfile
+import zipfile
+
+from django.http import StreamingHttpResponse
+
+from .downloads import CHUNK_SIZE
+
+ARCHIVE_FORMATS = {
+    'tar': ('application/x-tar', '.tar'),
+    'tar.gz': ('application/x-gzip', '.tar.gz'),
+    'zip': ('application/zip', '.zip'),
+}
+
+# Writing zip members chunk by chunk to an unseekable stream needs
+# ZipFile.open(..., 'w'), added in Python 3.6.
+ZIP_STREAMING = sys.version_info >= (3, 6)
+
+# Already compressed files are stored as is in zip archives.
+STORED_EXTENSIONS = set([
+    '7z', 'bz2', 'docx', 'flac', 'gif', 'gz', 'jpeg', 'jpg', 'mkv', 'mov',
+    'mp3', 'mp4', 'ogg', 'pdf', 'png', 'pptx', 'rar', 'webm', 'webp', 'xlsx',
+    'xz', 'zip',
+])
+
+
+class StreamBuffer(object):
+    """
+    Write-only file object collecting what an archiver writes until it is
+    drained and sent to the client.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_entries(paths):
+    """
+    Yield ``(path, arcname, stat)`` for every file, folder and symlink in
+    ``paths``, each folder before its content. Symlinks are not followed.
+    """
+    for root in paths:
+        root = root.rstrip(os.sep)
+        base = os.path.dirname(root)
+        st = os.lstat(root)
+        yield root, os.path.basename(root), st
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in sorted(dirnames) + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                yield path, os.path.relpath(path, base), st
+            dirnames.sort()
+
+
+def read_chunks(path, size=None):
+    with open(path, 'rb') as f:
+        while size is None or size > 0:
+            data = f.read(CHUNK_SIZE if size is None else min(CHUNK_SIZE, size))
+            if not data:
+                break
+            if size is not None:
+                size -= len(data)
+            yield data
+
+
+def tar_stream(paths, compresslevel=None):
+    """
+    Generate a tar archive of ``paths``, gzipped when ``compresslevel`` is
+    given. Headers and file data are written directly so that at most one
+    chunk of a file is held in memory at a time.
+    """
+    buf = StreamBuffer()
+    out = buf
+    if compresslevel is not None:
+        out = gzip.GzipFile(
+            filename='',
+            mode='wb',
+            fileobj=buf,
+            compresslevel=compresslevel,
+        )
+    offset = 0
+    for path, arcname, st in iter_entries(paths):
+        info = tarfile.TarInfo(arcname)
+        info.mtime = st.st_mtime
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid, info.gid = st.st_uid, st.st_gid
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            info.size = st.st_size
+        else:
+            continue
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        out.write(header)
+        offset += len(header)
+        if info.isreg():
+            written = 0
+            for chunk in read_chunks(path, info.size):
+                out.write(chunk)
+                written += len(chunk)
+                data = buf.drain()
+                if data:
+                    yield data
+            # a file that shrank while being read is padded to its
+            # announced size to keep the archive consistent
+            padding = info.size - written
+            remainder = info.size % tarfile.BLOCKSIZE
+            if remainder:
+                padding += tarfile.BLOCKSIZE - remainder
+            out.write(tarfile.NUL * padding)
+            offset += written + padding
+        data = buf.drain()
+        if data:
+            yield data
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    offset += len(end)
+    remainder = offset % tarfile.RECORDSIZE
+    if remainder:
+        end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    out.write(end)
+    if out is not buf:
+        out.close()
+    yield buf.drain()
+
+
+def zip_stream(paths):
+    """
+    Generate a ZIP64 capable zip archive of ``paths``. Already compressed
+    media is stored, everything else deflated. Symlinks are skipped.
+    """
+    buf = StreamBuffer()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    for path, arcname, st in iter_entries(paths):
+        if stat.S_ISDIR(st.st_mode):
+            archive.writestr(zipfile.ZipInfo.from_file(path, arcname), b'')
+        elif stat.S_ISREG(st.st_mode):
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            if arcname.rsplit('.', 1)[-1].lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            force_zip64 = info.file_size > zipfile.ZIP64_LIMIT
+            with archive.open(info, 'w', force_zip64=force_zip64) as dest:
+                for chunk in read_chunks(path):
+                    dest.write(chunk)
+                    data = buf.drain()
+                    if data:
+                        yield data
+        data = buf.drain()
+        if data:
+            yield data
+    archive.close()
+    yield buf.drain()
+
+
+def archive_response(paths, name, archive_format, compresslevel):
+    """
+    StreamingHttpResponse sending ``paths`` as a single archive called
+    ``name``. Unknown formats, and zip before Python 3.6, fall back to
+    tar.gz.
+    """
+    if archive_format not in ARCHIVE_FORMATS or (
+            archive_format == 'zip' and not ZIP_STREAMING):
+        archive_format = 'tar.gz'
+    if archive_format == 'zip':
+        content = zip_stream(paths)
+    elif archive_format == 'tar.gz':
+        content = tar_stream(paths, compresslevel)
+    else:
+        content = tar_stream(paths)
+    content_type, extension = ARCHIVE_FORMATS[archive_format]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = (
+        'attachment; filename=%s%s' % (name, extension)
+    )
+    return response
@@ -0,0 +1,103 @@
+import hashlib
+import re
+
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.text import compress_string
+
+accepts_gzip = re.compile(r'\bgzip\b')
+
+# responses smaller than this are not worth compressing
+GZIP_MIN_LENGTH = 200
+
+
+def make_etag(*parts):
+    """
+    Strong ETag value built from the given parts (path, mtime, size...).
+    """
+    key = '|'.join(str(part) for part in parts)
+    return '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def not_modified(request, etag, mtime):
+    """
+    Whether the client copy validated by If-None-Match or, failing that,
+    If-Modified-Since is still current.
+    """
+    if request is None:
+        return False
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        return etag_matches(request, etag)
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+    )
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def etag_matches(request, etag):
+    """
+    Whether ``etag``, strong or weak, is in the If-None-Match header.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    etags = [e.strip() for e in if_none_match.split(',')]
+    return '*' in etags or etag in etags or 'W/' + etag in etags
+
+
+def accepts(request, mimetype):
+    """
+    Whether the Accept header of ``request`` names ``mimetype`` itself,
+    with a quality above 0.
+    """
+    if request is None:
+        return False
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        parts = [p.strip() for p in media_range.split(';')]
+        if parts[0].lower() != mimetype:
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def set_validators(response, etag, mtime):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    return response
+
+
+def not_modified_response(etag, mtime):
+    return set_validators(HttpResponseNotModified(), etag, mtime)
+
+
+def gzip_response(request, response):
+    """
+    Compress the content of ``response`` when the client accepts gzip, the
+    way GZipMiddleware does, for sites that don't use it.
+    """
+    if (
+            response.streaming
+            or response.has_header('Content-Encoding')
+            or len(response.content) < GZIP_MIN_LENGTH
+    ):
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if not accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        return response
+    compressed = compress_string(response.content)
+    if len(compressed) >= len(response.content):
+        return response
+    response.content = compressed
+    response['Content-Length'] = str(len(compressed))
+    response['Content-Encoding'] = 'gzip'
+    # the compressed bytes differ from what a strong ETag was made for
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+    return response
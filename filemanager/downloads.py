@@ -0,0 +1,179 @@
+import os
+import re
+import uuid
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_http_date_safe
+
+from . import settings
+from .conditional import (make_etag, not_modified, not_modified_response,
+                          set_validators)
+from .mime import guess_type
+
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+
+CHUNK_SIZE = 64*1024
+
+# Requests asking for more ranges than this get the whole file instead.
+MAX_RANGES = 16
+
+range_re = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range(header, size):
+    """
+    Parse a ``Range: bytes=...`` header into a list of inclusive
+    ``(start, end)`` tuples. None means the header should be ignored and
+    an empty list that none of the ranges can be satisfied.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        match = range_re.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # suffix range, the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+            if not int(last):
+                continue
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_matches(request, etag, mtime):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(mtime) <= date
+
+
+def read_range(filepath, start, end):
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def read_ranges(filepath, parts, boundary):
+    for header, start, end in parts:
+        yield header
+        for data in read_range(filepath, start, end):
+            yield data
+    yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+
+def sendfile_response(filepath, content_type):
+    """
+    Empty response asking the front proxy to send ``filepath``, or None if
+    offloading isn't configured or doesn't apply to this file.
+    """
+    backend = settings.FILEMANAGER_SENDFILE
+    filepath = os.path.abspath(filepath)
+    if backend == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = filepath
+        return response
+    if backend == 'x-accel-redirect':
+        root = os.path.join(os.path.abspath(settings.FILEMANAGER_SENDFILE_ROOT), '')
+        if not filepath.startswith(root):
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = (
+            settings.FILEMANAGER_SENDFILE_URL.rstrip('/')
+            + '/'
+            + quote(filepath[len(root):].encode('utf-8'))
+        )
+        return response
+    return None
+
+
+def stream_response(request, filepath, content_type, size, etag, mtime):
+    ranges = None
+    range_header = request.META.get('HTTP_RANGE') if request else None
+    if range_header and if_range_matches(request, etag, mtime):
+        ranges = parse_range(range_header, size)
+    if ranges is None:
+        response = FileResponse(open(filepath, 'rb'), content_type=content_type)
+        response.block_size = CHUNK_SIZE
+        response['Content-Length'] = size
+    elif not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            read_range(filepath, start, end),
+            status=206,
+            content_type=content_type,
+        )
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = len('\r\n--%s--\r\n' % boundary)
+        for start, end in ranges:
+            header = (
+                '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                % (boundary, content_type, start, end, size)
+            ).encode('ascii')
+            parts.append((header, start, end))
+            length += len(header) + end - start + 1
+        response = StreamingHttpResponse(
+            read_ranges(filepath, parts, boundary),
+            status=206,
+            content_type='multipart/byteranges; boundary=' + boundary,
+        )
+        response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def file_response(request, filepath, filename):
+    """
+    Response sending the file at ``filepath`` as an attachment, either
+    offloaded to the front proxy or streamed in CHUNK_SIZE blocks with
+    support for single and multiple byte ranges.
+    """
+    st = os.stat(filepath)
+    content_type = (
+        guess_type(filepath) or 'application/octet-stream'
+    )
+    etag = make_etag(os.path.abspath(filepath), st.st_mtime, st.st_size)
+    if not_modified(request, etag, st.st_mtime):
+        return not_modified_response(etag, st.st_mtime)
+    response = sendfile_response(filepath, content_type)
+    if response is None:
+        response = stream_response(
+            request,
+            filepath,
+            content_type,
+            st.st_size,
+            etag,
+            st.st_mtime,
+        )
+    response['Content-Disposition'] = 'attachment; filename=' + filename
+    return set_validators(response, etag, st.st_mtime)
@@ -0,0 +1,205 @@
+import itertools
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .uploads import iter_chunks, save_chunks, type_allowed
+
+# Members of one ZipFile can only be read from several threads at once
+# since Python 3.4, before that they are extracted one after the other.
+PARALLEL_READS = sys.version_info >= (3, 4)
+
+
+class ArchiveRejected(Exception):
+    pass
+
+
+class Report(object):
+    """
+    What became of the members of an archive.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.extracted = []
+        self.rejected = []
+        # bytes added, less the size of the files replaced
+        self.bytes = 0
+        self.folders = 0
+
+    def reject(self, name, reason):
+        self.rejected.append((name, reason))
+
+    def messages(self):
+        if not self.rejected:
+            return ['Extraction completed successfully.']
+        messages = [
+            'Extracted %d of %d files from %s'
+            % (
+                len(self.extracted),
+                len(self.extracted) + len(self.rejected),
+                self.archive,
+            )
+        ]
+        for name, reason in self.rejected:
+            messages.append('File in the zip is not allowed : %s (%s)' % (name, reason))
+        return messages
+
+
+def check_archive(infos, max_size=None, max_ratio=None):
+    """
+    Refuse an archive from its central directory alone, before anything
+    is written, when it expands to more than ``max_size`` bytes or when its
+    members are compressed more than ``max_ratio`` times overall.
+    """
+    size = sum(info.file_size for info in infos)
+    compressed = sum(info.compress_size for info in infos)
+    if max_size is not None and size > max_size:
+        raise ArchiveRejected(
+            'it expands to %d bytes, more than the %d bytes available'
+            % (size, max_size)
+        )
+    if max_ratio and size > max_ratio * max(compressed, 1):
+        raise ArchiveRejected(
+            'it is compressed %d times, more than %d'
+            % (size // max(compressed, 1), max_ratio)
+        )
+    return size
+
+
+def member_target(root, name):
+    """
+    Where the member ``name`` goes under ``root``, or None if it would end up
+    outside of it.
+    """
+    target = os.path.normpath(os.path.join(root, name))
+    if not target.startswith(root + os.sep):
+        return None
+    return target
+
+
+def extract_member(zip_ref, info, target, extensions):
+    """
+    Extract one member, checking its type on its first decompressed chunk
+    before anything is written. Returns the bytes written, or None if the
+    type is not allowed.
+    """
+    with zip_ref.open(info) as member:
+        chunks = bounded(iter_chunks(member), info.file_size)
+        first = next(chunks, b'')
+        if not type_allowed(first, extensions):
+            return None
+        return save_chunks(itertools.chain([first], chunks), target)
+
+
+def replaced_size(target):
+    """
+    Size of the file a member extracted to ``target`` replaces, 0 if there
+    is none.
+    """
+    try:
+        st = os.lstat(target)
+    except OSError:
+        return 0
+    return st.st_size if stat.S_ISREG(st.st_mode) else 0
+
+
+def bounded(chunks, limit):
+    """
+    Pass ``chunks`` through, failing once they add up to more than the
+    ``limit`` bytes the archive declared.
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            raise ValueError('larger than declared')
+        yield chunk
+
+
+def extract(zip_ref, directory, extensions=None, max_size=None,
+            max_ratio=None, workers=1, progress=None):
+    """
+    Extract the open ZipFile ``zip_ref`` into ``directory`` and close it.
+    The whole archive is refused with ArchiveRejected if check_archive()
+    does not pass, then members with a path outside of ``directory`` or an
+    extension not in ``extensions`` are skipped and the others are
+    extracted by ``workers`` threads. Returns a Report.
+    """
+    report = Report(os.path.basename(zip_ref.filename))
+    root = os.path.normpath(directory)
+    with zip_ref:
+        infos = zip_ref.infolist()
+        check_archive(infos, max_size, max_ratio)
+        members = []
+        folders = set()
+        for info in infos:
+            name = info.filename
+            target = member_target(root, name)
+            if target is None:
+                report.reject(name, 'path outside of the folder')
+                if progress:
+                    progress(files=1)
+                continue
+            if name.endswith('/'):
+                folders.add(target)
+                if progress:
+                    progress(files=1)
+                continue
+            if extensions and not name.endswith(tuple(extensions)):
+                report.reject(name, 'extension not allowed')
+                if progress:
+                    progress(files=1)
+                continue
+            folders.add(os.path.dirname(target))
+            members.append((info, target))
+        report.folders = make_folders(root, folders)
+
+        def run(member):
+            info, target = member
+            replaced = replaced_size(target)
+            try:
+                size, error = extract_member(zip_ref, info, target, extensions), None
+            except Exception as e:
+                size, error = None, 'could not be extracted : ' + str(e)
+            if size is None and error is None:
+                error = 'file type not allowed'
+            if progress:
+                progress(bytes=size or 0, files=1)
+            return size, replaced, error
+
+        if not PARALLEL_READS:
+            workers = 1
+        executor = ThreadPoolExecutor(max(1, workers))
+        try:
+            results = list(executor.map(run, members))
+        finally:
+            executor.shutdown()
+    for (info, target), (size, replaced, error) in zip(members, results):
+        if error:
+            report.reject(info.filename, error)
+        else:
+            report.extracted.append(info.filename)
+            report.bytes += size - replaced
+    # in the order of the archive
+    order = dict((info.filename, i) for i, info in enumerate(infos))
+    report.rejected.sort(key=lambda rejected: order[rejected[0]])
+    return report
+
+
+def make_folders(root, folders):
+    """
+    Create ``folders`` and their missing parents up to ``root``. Returns how
+    many folders were created.
+    """
+    created = set()
+    for folder in sorted(folders):
+        missing = []
+        while folder != root and not os.path.isdir(folder):
+            missing.append(folder)
+            folder = os.path.dirname(folder)
+        for folder in reversed(missing):
+            os.mkdir(folder)
+            created.add(folder)
+    return len(created)
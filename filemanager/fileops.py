@@ -0,0 +1,76 @@
+import errno
+import os
+import shutil
+
+from .uploads import iter_chunks
+
+
+def copy_file(src, dst, progress=None):
+    """
+    Copy the file ``src`` to ``dst`` with its permission bits and times,
+    calling ``progress(bytes=...)`` as data is written. Returns its size.
+    """
+    size = 0
+    with open(src, 'rb') as source:
+        with open(dst, 'wb') as dest:
+            for chunk in iter_chunks(source):
+                dest.write(chunk)
+                size += len(chunk)
+                if progress:
+                    progress(bytes=len(chunk))
+    shutil.copystat(src, dst)
+    if progress:
+        progress(files=1)
+    return size
+
+
+def copy(src, dst, progress=None):
+    """
+    Copy the file or folder ``src`` to ``dst`` like shutil.copy/copytree
+    (symlinks inside folders are copied as symlinks) while reporting
+    progress. Returns ``(bytes, folders)`` created.
+    """
+    if not os.path.isdir(src):
+        return copy_file(src, dst, progress), 0
+    size = 0
+    folders = 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        if dirpath == src:
+            target = dst
+            os.makedirs(target)
+        else:
+            target = os.path.join(dst, os.path.relpath(dirpath, src))
+            os.mkdir(target)
+        shutil.copystat(dirpath, target)
+        folders += 1
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                size += copy_file(path, os.path.join(target, name), progress)
+    return size, folders
+
+
+def move(src, dst, progress=None):
+    """
+    Move ``src`` to ``dst``: a rename on the same filesystem, otherwise a
+    copy reporting progress followed by removing ``src``.
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy(src, dst, progress)
+    if os.path.isdir(src):
+        shutil.rmtree(src)
+    else:
+        os.remove(src)
+
+
+def same_device(src, dst_directory):
+    return os.stat(src).st_dev == os.stat(dst_directory).st_dev
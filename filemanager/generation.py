@@ -0,0 +1,58 @@
+import contextlib
+import os
+import threading
+
+from .utils import state_path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non POSIX platforms
+    fcntl = None
+
+
+class TreeGeneration(object):
+    """
+    Counter of the changes made to the tree of a basepath, kept in the
+    state directory so that every process sees the same value. Pages are
+    validated with an ETag built from it instead of walking the tree.
+    """
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return state_path(self.basepath, 'generation')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def bump(self):
+        """
+        Record a change; returns the new generation.
+        """
+        with self._locked():
+            generation = self.get() + 1
+            tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.current_thread().ident)
+            with open(tmp, 'w') as f:
+                f.write(str(generation))
+            os.rename(tmp, self.path)
+            return generation
@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import settings
+
+
+class Job(object):
+    """
+    A file operation and its progress. ``work(job)`` does the operation,
+    reports progress with ``job.progress()`` and returns the messages to
+    show once it is finished.
+    """
+
+    def __init__(self, basepath, action, work, bytes_total=0, files_total=0):
+        self.id = uuid.uuid4().hex
+        self.basepath = basepath
+        self.action = action
+        self.work = work
+        self.status = 'queued'
+        self.bytes_total = bytes_total
+        self.bytes_done = 0
+        self.files_total = files_total
+        self.files_done = 0
+        self.messages = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def progress(self, bytes=0, files=0):
+        with self._lock:
+            self.bytes_done += bytes
+            self.files_done += files
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.messages = self.work(self)
+            self.status = 'done'
+        except Exception as e:
+            self.messages = ['Unexpected error : ' + str(e)]
+            self.status = 'failed'
+        self.finished = time.time()
+        return self.messages
+
+    def eta(self):
+        """
+        Estimated seconds left, from the throughput so far.
+        """
+        if self.status != 'running' or not self.bytes_done or not self.bytes_total:
+            return None
+        elapsed = time.time() - self.started
+        remaining = max(0, self.bytes_total - self.bytes_done)
+        return int(elapsed * remaining / self.bytes_done)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'status': self.status,
+            'bytes_total': self.bytes_total,
+            'bytes_done': self.bytes_done,
+            'files_total': self.files_total,
+            'files_done': self.files_done,
+            'eta': self.eta(),
+            'messages': list(map(str, self.messages)),
+        }
+
+
+class JobQueue(object):
+    """
+    Runs jobs on a bounded thread pool, with at most ``per_basepath`` jobs
+    of a basepath running at once; the others wait for their turn without
+    holding a worker. Finished jobs are kept ``ttl`` seconds for status
+    queries.
+    """
+
+    def __init__(self, workers, per_basepath, ttl):
+        self.per_basepath = per_basepath
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(workers)
+        self._jobs = {}
+        self._running = collections.defaultdict(int)
+        self._pending = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+            if self._running[job.basepath] < self.per_basepath:
+                self._running[job.basepath] += 1
+                self._executor.submit(self._run, job)
+            else:
+                self._pending[job.basepath].append(job)
+        return job
+
+    def _run(self, job):
+        try:
+            job.run()
+        finally:
+            with self._lock:
+                pending = self._pending[job.basepath]
+                if pending:
+                    self._executor.submit(self._run, pending.popleft())
+                else:
+                    del self._pending[job.basepath]
+                    self._running[job.basepath] -= 1
+                    if not self._running[job.basepath]:
+                        del self._running[job.basepath]
+
+    def _purge(self):
+        expired = time.time() - self.ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished < expired:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def depth(self):
+        """
+        Number of jobs queued or running.
+        """
+        with self._lock:
+            return (
+                sum(self._running.values())
+                + sum(len(p) for p in self._pending.values())
+            )
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def job_queue():
+    """
+    The process wide JobQueue, created on first use.
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(
+                settings.FILEMANAGER_JOB_WORKERS,
+                settings.FILEMANAGER_JOB_PER_BASEPATH,
+                settings.FILEMANAGER_JOB_TTL,
+            )
+    return _job_queue
@@ -0,0 +1,122 @@
+import contextlib
+import json
+import os
+import threading
+
+from .utils import is_temporary, state_path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non POSIX platforms
+    fcntl = None
+
+
+def measure(path):
+    """
+    Return ``(bytes, folders)`` used by ``path``. For a directory the folder
+    count includes the directory itself, for a file it is 0.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path), 0
+    total_size = 0
+    folders = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        folders += 1
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            if not is_temporary(f) and not os.path.islink(fp):
+                total_size += os.path.getsize(fp)
+    return total_size, folders
+
+
+class UsageLedger(object):
+    """
+    Persistent record of the bytes and folders used under a basepath.
+
+    Actions adjust the counters with the delta they caused instead of
+    walking the whole tree again, so quota checks cost a single small read.
+    The record is rebuilt from disk when it is missing or on request.
+    """
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return state_path(self.basepath, 'usage.json')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return {'bytes': int(data['bytes']), 'folders': int(data['folders'])}
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, data):
+        tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self.path)
+
+    def _rebuild(self):
+        size, folders = measure(self.basepath)
+        data = {'bytes': size, 'folders': folders}
+        self._write(data)
+        return data
+
+    def get(self):
+        """
+        Return ``{'bytes': ..., 'folders': ...}``, rebuilding if needed.
+        """
+        data = self._read()
+        if data is None:
+            with self._locked():
+                data = self._read() or self._rebuild()
+        return data
+
+    @property
+    def bytes(self):
+        return self.get()['bytes']
+
+    @property
+    def folders(self):
+        return self.get()['folders']
+
+    def update(self, bytes=0, folders=0):
+        """
+        Apply a delta caused by an action that has already hit the disk.
+        If there is no record yet it is rebuilt, which already includes the
+        change, so the delta is not applied a second time.
+        """
+        if not bytes and not folders:
+            return
+        with self._locked():
+            data = self._read()
+            if data is None:
+                self._rebuild()
+                return
+            data['bytes'] = max(0, data['bytes'] + bytes)
+            data['folders'] = max(1, data['folders'] + folders)
+            self._write(data)
+
+    def rebuild(self):
+        """
+        Reconcile the record with what is actually on disk.
+        """
+        with self._locked():
+            return self._rebuild()
@@ -0,0 +1,204 @@
+import bisect
+import collections
+import os
+import threading
+import time
+
+from . import settings
+from .utils import is_temporary
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+
+# Directories modified this recently are not cached: on filesystems with a
+# coarse mtime resolution another change could follow within the same tick.
+RACY_WINDOW = 2
+
+Entry = collections.namedtuple(
+    'Entry',
+    ['name', 'is_dir', 'is_link', 'size', 'mtime'],
+)
+
+# Folders come first, ties are broken by name so that every entry has a
+# distinct key to resume a page from.
+SORT_KEYS = {
+    'name': lambda e: (not e.is_dir, e.name.lower(), e.name),
+    'size': lambda e: (not e.is_dir, e.size, e.name.lower(), e.name),
+    'mtime': lambda e: (not e.is_dir, e.mtime, e.name.lower(), e.name),
+}
+
+
+class Listing(object):
+    """
+    The entries directly inside a directory, with the stat data gathered
+    while scanning it. ``key`` identifies the state of the directory the
+    listing was taken from. Listings are shared, do not mutate them.
+    """
+
+    def __init__(self, key, entries):
+        self.key = key
+        self.entries = entries
+        self.dirs = [e.name for e in entries if e.is_dir]
+        self.files = [e.name for e in entries if not e.is_dir]
+        self.links = set(e.name for e in entries if e.is_dir and e.is_link)
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sorted(self, sort='name', ext=None):
+        """
+        ``(keys, entries)`` sorted by SORT_KEYS[sort], only the files with
+        the extension ``ext`` if given. Computed once per listing.
+        """
+        cached = self._sorted.get((sort, ext))
+        if cached is None:
+            key = SORT_KEYS[sort]
+            entries = self.entries
+            if ext:
+                suffix = '.' + ext.lower()
+                entries = [
+                    e for e in entries
+                    if not e.is_dir and e.name.lower().endswith(suffix)
+                ]
+            entries = sorted(entries, key=key)
+            if len(self._sorted) >= 8:
+                self._sorted.clear()
+            cached = self._sorted[(sort, ext)] = (
+                [key(e) for e in entries],
+                entries,
+            )
+        return cached
+
+    def page(self, sort='name', reverse=False, ext=None, after=None, limit=100):
+        """
+        Up to ``limit`` entries following the one with the sort key
+        ``after``, and the key to pass as ``after`` for the next page or
+        None. Keys rather than positions are used, so entries added or
+        removed in the meantime do not shift the pages.
+        """
+        keys, entries = self.sorted(sort, ext)
+        if not reverse:
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            end = start + limit
+            page = entries[start:end]
+            more = end < len(entries)
+        else:
+            end = len(entries) if after is None else bisect.bisect_left(keys, after)
+            start = max(0, end - limit)
+            page = entries[start:end][::-1]
+            more = start > 0
+        next_key = SORT_KEYS[sort](page[-1]) if page and more else None
+        return page, next_key
+
+
+def stat_key(st):
+    return (st.st_dev, st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+def scan(path):
+    """
+    List ``path`` with a single scandir pass.
+    """
+    entries = []
+    for entry in scandir(path):
+        if is_temporary(entry.name):
+            continue
+        try:
+            is_dir = entry.is_dir()
+            is_link = entry.is_symlink()
+        except OSError:
+            continue
+        size, mtime = 0, 0
+        if not is_dir:
+            try:
+                st = entry.stat()
+                size, mtime = st.st_size, st.st_mtime
+            except OSError:
+                # dangling symlink
+                pass
+        entries.append(Entry(entry.name, is_dir, is_link, size, mtime))
+    return entries
+
+
+class ListingCache(object):
+    """
+    Process wide LRU cache of directory listings.
+
+    A listing is reused as long as the device, inode and mtime of its
+    directory are unchanged, so checking an entry costs one stat call.
+    The cache is bounded by the total number of entries it holds.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._listings = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = stat_key(st)
+        with self._lock:
+            listing = self._listings.pop(path, None)
+            if listing is not None:
+                if listing.key == key:
+                    self._listings[path] = listing
+                    self.hits += 1
+                    return listing
+                self._size -= len(listing)
+            self.misses += 1
+        listing = Listing(key, scan(path))
+        if time.time() - st.st_mtime > RACY_WINDOW:
+            self._store(path, listing)
+        return listing
+
+    def _store(self, path, listing):
+        if len(listing) > self.max_entries:
+            return
+        with self._lock:
+            old = self._listings.pop(path, None)
+            if old is not None:
+                self._size -= len(old)
+            self._listings[path] = listing
+            self._size += len(listing)
+            while self._size > self.max_entries:
+                _, evicted = self._listings.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self, path=None):
+        """
+        Drop the listing of ``path``, or every listing if no path is given.
+        """
+        with self._lock:
+            if path is None:
+                self._listings.clear()
+                self._size = 0
+                return
+            listing = self._listings.pop(path, None)
+            if listing is not None:
+                self._size -= len(listing)
+
+    def invalidate_tree(self, root):
+        """
+        Drop the listings of ``root`` and of every folder under it.
+        """
+        root = root.rstrip(os.sep)
+        with self._lock:
+            for path in list(self._listings):
+                if path == root or path.startswith(root + os.sep):
+                    self._size -= len(self._listings.pop(path))
+
+
+listing_cache = ListingCache(settings.FILEMANAGER_LISTING_CACHE_SIZE)
+
+
+def list_directory(path):
+    """
+    Return the Listing of the absolute directory ``path``.
+    """
+    return listing_cache.get(path)
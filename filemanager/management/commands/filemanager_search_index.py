@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from filemanager.search import SearchIndex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the filename search index of filemanager basepaths.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('basepath', nargs='+')
+
+    def handle(self, *args, **options):
+        for basepath in options['basepath']:
+            count = SearchIndex(basepath.rstrip('/')).rebuild()
+            self.stdout.write('%s: %d files and folders indexed' % (basepath, count))
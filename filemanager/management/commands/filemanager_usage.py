@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from filemanager.ledger import UsageLedger
+
+
+class Command(BaseCommand):
+    help = 'Show or rebuild the disk usage ledger of filemanager basepaths.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('basepath', nargs='+')
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help='Walk the basepath and reconcile the ledger with the disk.',
+        )
+
+    def handle(self, *args, **options):
+        for basepath in options['basepath']:
+            ledger = UsageLedger(basepath.rstrip('/'))
+            if options['rebuild']:
+                usage = ledger.rebuild()
+            else:
+                usage = ledger.get()
+            self.stdout.write(
+                '%s: %d bytes in %d folders'
+                % (basepath, usage['bytes'], usage['folders'])
+            )
@@ -0,0 +1,182 @@
+import contextlib
+import threading
+import timeit
+
+from django.dispatch import Signal
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from . import settings
+from .jobs import job_queue
+from .listing import listing_cache
+from .mime import mime_detector
+from .thumbnails import thumbnail_cache
+
+# Sent for every measurement with the arguments name, kind ('counter',
+# 'gauge' or 'timing'), value and labels (a dict).
+metric_recorded = Signal()
+
+
+class Registry(object):
+    """
+    Process wide totals of the measurements: counters are summed, timings
+    are kept as a count and a sum, gauges keep their last value.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, kind, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if kind == 'counter':
+                self.counters[key] = self.counters.get(key, 0) + value
+            elif kind == 'timing':
+                count, total = self.timings.get(key, (0, 0.0))
+                self.timings[key] = (count + 1, total + value)
+            else:
+                self.gauges[key] = value
+
+    def prometheus(self):
+        """
+        The totals in the Prometheus text exposition format, timings as
+        summaries without quantiles.
+        """
+        lines = []
+        with self._lock:
+            samples = [
+                ('counter', name, labels, '', value)
+                for (name, labels), value in self.counters.items()
+            ] + [
+                ('gauge', name, labels, '', value)
+                for (name, labels), value in self.gauges.items()
+            ]
+            for (name, labels), (count, total) in self.timings.items():
+                samples.append(('summary', name, labels, '_count', count))
+                samples.append(('summary', name, labels, '_sum', total))
+        typed = set()
+        for kind, name, labels, suffix, value in sorted(samples, key=lambda s: s[1:4]):
+            if name not in typed:
+                lines.append('# TYPE %s %s' % (name, kind))
+                typed.add(name)
+            label_text = ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels
+            )
+            lines.append('%s%s%s %s' % (
+                name,
+                suffix,
+                '{' + label_text + '}' if label_text else '',
+                repr(float(value)) if isinstance(value, float) else value,
+            ))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+_hook = None
+_hook_lock = threading.Lock()
+
+
+def get_hook():
+    """
+    The callable named by FILEMANAGER_METRICS_HOOK, imported on first use.
+    """
+    global _hook
+    if _hook is None and settings.FILEMANAGER_METRICS_HOOK:
+        with _hook_lock:
+            if _hook is None:
+                hook = settings.FILEMANAGER_METRICS_HOOK
+                _hook = import_string(hook) if isinstance(hook, str) else hook
+    return _hook
+
+
+def record(name, kind, value, **labels):
+    registry.record(name, kind, value, labels)
+    metric_recorded.send(sender=None, name=name, kind=kind, value=value, labels=labels)
+    hook = get_hook()
+    if hook:
+        hook(name, kind, value, labels)
+
+
+def record_action(action, seconds, bytes=0, files=0):
+    record('filemanager_action_seconds', 'timing', seconds, action=action)
+    record('filemanager_actions_total', 'counter', 1, action=action)
+    if bytes:
+        record('filemanager_action_bytes_total', 'counter', bytes, action=action)
+    if files:
+        record('filemanager_action_files_total', 'counter', files, action=action)
+
+
+# The caches count their hits and misses themselves; what was not reported
+# yet is sent after each request, so every hit is reported exactly once.
+_reported = {}
+_reported_lock = threading.Lock()
+
+
+def record_state():
+    """
+    Report the cache hits and misses since the last call and the depth of
+    the job queue.
+    """
+    counts = {
+        'filemanager_listing_cache_hits_total': listing_cache.hits,
+        'filemanager_listing_cache_misses_total': listing_cache.misses,
+        'filemanager_thumbnail_cache_hits_total': thumbnail_cache.hits,
+        'filemanager_thumbnail_cache_misses_total': thumbnail_cache.misses,
+        'filemanager_mime_cache_hits_total': mime_detector.hits,
+        'filemanager_mime_cache_misses_total': mime_detector.misses,
+    }
+    with _reported_lock:
+        deltas = dict(
+            (name, value - _reported.get(name, 0))
+            for name, value in counts.items()
+        )
+        _reported.update(counts)
+    for name, delta in sorted(deltas.items()):
+        if delta:
+            record(name, 'counter', delta)
+    record('filemanager_job_queue_depth', 'gauge', job_queue().depth())
+
+
+class Timings(object):
+    """
+    Durations of the phases of one request.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            seconds = timeit.default_timer() - start
+            self.phases.append((name, seconds))
+            record('filemanager_phase_seconds', 'timing', seconds, phase=name)
+
+    def server_timing(self):
+        """
+        Value of a Server-Timing header for the phases.
+        """
+        return ', '.join(
+            '%s;dur=%.1f' % (name, seconds * 1000)
+            for name, seconds in self.phases
+        )
+
+
+def prometheus_view(request):
+    """
+    The metrics of this process in the Prometheus text format, route it
+    at the url Prometheus scrapes.
+    """
+    record_state()
+    return HttpResponse(
+        registry.prometheus(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
@@ -0,0 +1,145 @@
+import collections
+import mimetypes
+import os
+import threading
+
+import magic
+
+from . import settings
+
+_init_lock = threading.Lock()
+_extensions = {}
+
+
+def init():
+    """
+    Load the mimetypes tables once for the whole process.
+    """
+    if not mimetypes.inited:
+        with _init_lock:
+            if not mimetypes.inited:
+                mimetypes.init()
+
+
+def guess_type(name):
+    """
+    Type of a file from its name, None if unknown.
+    """
+    init()
+    return mimetypes.guess_type(name)[0]
+
+
+def type_extensions(mimetype):
+    """
+    The extensions, without the dot, of the files of type ``mimetype``.
+    """
+    extensions = _extensions.get(mimetype)
+    if extensions is None:
+        init()
+        extensions = frozenset(
+            ext[1:] for ext in mimetypes.guess_all_extensions(mimetype)
+        )
+        _extensions[mimetype] = extensions
+    return extensions
+
+
+class AllowedTypes(object):
+    """
+    Content types matching one of ``extensions``; everything is allowed
+    without an extensions list.
+    """
+
+    def __init__(self, extensions):
+        self.extensions = frozenset(extensions) if extensions else None
+        self._allowed = {}
+
+    def allows(self, mimetype):
+        if self.extensions is None:
+            return True
+        allowed = self._allowed.get(mimetype)
+        if allowed is None:
+            allowed = not self.extensions.isdisjoint(type_extensions(mimetype))
+            self._allowed[mimetype] = allowed
+        return allowed
+
+    def allows_data(self, data):
+        """
+        Whether content starting with ``data`` is of an allowed type.
+        libmagic only needs the first bytes of a file.
+        """
+        if self.extensions is None:
+            return True
+        return self.allows(magic.from_buffer(data, mime=True))
+
+
+_allowed_types = {}
+_allowed_types_lock = threading.Lock()
+
+
+def allowed_types(extensions):
+    """
+    The AllowedTypes of ``extensions``, made once per list of extensions.
+    """
+    key = frozenset(extensions) if extensions else None
+    allowed = _allowed_types.get(key)
+    if allowed is None:
+        with _allowed_types_lock:
+            allowed = _allowed_types.setdefault(key, AllowedTypes(extensions))
+    return allowed
+
+
+class MimeDetector(object):
+    """
+    Process wide LRU cache of the types libmagic detects in files, keyed
+    by device, inode, mtime and size so that a changed file is detected
+    again. Holds at most ``max_entries`` types.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._types = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def detect(self, path, st=None):
+        """
+        Type of the content of the file at ``path``, ``st`` is its stat
+        result if already known.
+        """
+        if st is None:
+            st = os.stat(path)
+        key = (
+            st.st_dev,
+            st.st_ino,
+            getattr(st, 'st_mtime_ns', st.st_mtime),
+            st.st_size,
+        )
+        with self._lock:
+            mimetype = self._types.pop(key, None)
+            if mimetype is not None:
+                self._types[key] = mimetype
+                self.hits += 1
+                return mimetype
+            self.misses += 1
+        mimetype = magic.from_file(path, mime=True)
+        if not self.max_entries:
+            return mimetype
+        with self._lock:
+            self._types[key] = mimetype
+            while len(self._types) > self.max_entries:
+                self._types.popitem(last=False)
+        return mimetype
+
+
+mime_detector = MimeDetector(settings.FILEMANAGER_MIME_CACHE_SIZE)
+
+
+def detect_type(path, st=None):
+    """
+    Detected type of the file at ``path``, None if it can't be read.
+    """
+    try:
+        return mime_detector.detect(path, st)
+    except (IOError, OSError, magic.MagicException):
+        return None
@@ -0,0 +1,232 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from .uploads import iter_chunks
+from .utils import TEMP_PREFIX, state_dir, state_path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non POSIX platforms
+    fcntl = None
+
+
+class OffsetMismatch(Exception):
+    """
+    A chunk was sent for another offset than the one the upload is at.
+    """
+
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__(
+            'Upload is at offset %d' % offset
+        )
+        self.offset = offset
+
+
+_session_locks = {}
+_session_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def session_lock(key):
+    """
+    Hold the thread lock of the session ``key``. Each session has its own,
+    kept while a thread holds or waits for it.
+    """
+    with _session_locks_lock:
+        lock, users = _session_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _session_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _session_locks_lock:
+            lock, users = _session_locks[key]
+            if users == 1:
+                del _session_locks[key]
+            else:
+                _session_locks[key] = (lock, users - 1)
+
+
+class UploadSession(object):
+    """
+    An upload sent in several requests. The metadata is kept in the state
+    directory of the basepath and the data is appended to a staging file in
+    the target folder, so that finalizing is a rename on the same
+    filesystem. The staging file is named with TEMP_PREFIX and is not
+    counted as used space until the upload is finalized.
+    """
+
+    def __init__(self, basepath, id, name, path, size, created):
+        self.basepath = basepath
+        self.id = id
+        self.name = name
+        self.path = path
+        self.size = size
+        self.created = created
+
+    @staticmethod
+    def metadata_path(basepath, id):
+        return state_path(basepath, 'upload-' + id + '.json')
+
+    @property
+    def staging_path(self):
+        return os.path.join(
+            self.basepath + self.path,
+            TEMP_PREFIX + 'upload-' + self.id,
+        )
+
+    @classmethod
+    def create(cls, basepath, name, path, size):
+        session = cls(basepath, uuid.uuid4().hex, name, path, size, time.time())
+        fd = os.open(
+            session.staging_path,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            0o666,
+        )
+        os.close(fd)
+        with open(cls.metadata_path(basepath, session.id), 'w') as f:
+            json.dump(
+                {
+                    'name': name,
+                    'path': path,
+                    'size': size,
+                    'created': session.created,
+                },
+                f,
+            )
+        return session
+
+    @classmethod
+    def load(cls, basepath, id):
+        """
+        The session ``id`` of ``basepath``, or None if there is none.
+        """
+        if not id.isalnum():
+            return None
+        try:
+            with open(cls.metadata_path(basepath, id)) as f:
+                data = json.load(f)
+            session = cls(
+                basepath,
+                id,
+                data['name'],
+                data['path'],
+                int(data['size']),
+                data['created'],
+            )
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if not os.path.exists(session.staging_path):
+            return None
+        return session
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with session_lock((self.basepath, self.id)):
+            if fcntl is None:
+                yield
+                return
+            lock_path = self.metadata_path(self.basepath, self.id) + '.lock'
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @property
+    def offset(self):
+        """
+        Number of bytes received so far.
+        """
+        return os.path.getsize(self.staging_path)
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def append(self, offset, stream):
+        """
+        Write the data read from ``stream`` at ``offset``, which must be
+        the current offset. Data beyond the announced size is refused.
+        Returns the new offset; if the stream breaks off, what was received
+        is kept and the client resumes from there.
+        """
+        with self._locked():
+            current = self.offset
+            if offset != current:
+                raise OffsetMismatch(current)
+            with open(self.staging_path, 'ab') as f:
+                for chunk in iter_chunks(stream):
+                    if current + len(chunk) > self.size:
+                        f.write(chunk[:self.size - current])
+                        raise ValueError('Upload is larger than announced')
+                    f.write(chunk)
+                    current += len(chunk)
+            return current
+
+    def first_chunk(self):
+        with open(self.staging_path, 'rb') as f:
+            return next(iter_chunks(f), b'')
+
+    def finish(self, filepath):
+        """
+        Move the complete upload to ``filepath`` and drop the session.
+        """
+        with self._locked():
+            os.rename(self.staging_path, filepath)
+            self._remove_metadata()
+
+    def delete(self):
+        with self._locked():
+            try:
+                os.remove(self.staging_path)
+            except OSError:
+                pass
+            self._remove_metadata()
+
+    def _remove_metadata(self):
+        path = self.metadata_path(self.basepath, self.id)
+        for p in (path, path + '.lock'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+
+def expire_sessions(basepath, max_age):
+    """
+    Delete the sessions of ``basepath`` not written to for ``max_age``
+    seconds.
+    """
+    directory = state_dir(basepath)
+    if not os.path.isdir(directory):
+        return
+    expired = time.time() - max_age
+    for name in os.listdir(directory):
+        if not (name.startswith('upload-') and name.endswith('.json')):
+            continue
+        path = os.path.join(directory, name)
+        session = UploadSession.load(basepath, name[len('upload-'):-len('.json')])
+        try:
+            last_write = os.path.getmtime(
+                session.staging_path if session else path
+            )
+        except OSError:
+            continue
+        if last_write >= expired:
+            continue
+        if session:
+            session.delete()
+        else:
+            # the staging file is already gone
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,398 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+from .listing import Entry, scan
+from .utils import is_temporary, state_path
+
+# The indexes are created once the files table is filled, which is much
+# faster than updating them row by row.
+SCHEMA = [
+    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE files ('
+    ' id INTEGER PRIMARY KEY,'
+    ' path TEXT UNIQUE NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' lname TEXT NOT NULL,'
+    ' ext TEXT NOT NULL,'
+    ' is_dir INTEGER NOT NULL,'
+    ' size INTEGER NOT NULL,'
+    ' mtime REAL NOT NULL,'
+    ' is_link INTEGER NOT NULL)',
+]
+# Stored as the 'built' value of the meta table, indexes built with another
+# schema are rebuilt.
+SCHEMA_VERSION = '2'
+INDEXES = [
+    'CREATE INDEX files_lname ON files (lname, path)',
+    'CREATE INDEX files_ext ON files (ext, lname, path)',
+]
+
+# Substring search through a trigram full text index, kept in sync with
+# the files table by triggers. Needs SQLite 3.34+ built with FTS5.
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE names USING fts5("
+    " name, content='files', content_rowid='id', tokenize='trigram')",
+    "INSERT INTO names (names) VALUES ('rebuild')",
+    'CREATE TRIGGER files_ai AFTER INSERT ON files BEGIN'
+    ' INSERT INTO names (rowid, name) VALUES (new.id, new.name); END',
+    'CREATE TRIGGER files_ad AFTER DELETE ON files BEGIN'
+    " INSERT INTO names (names, rowid, name) VALUES ('delete', old.id, old.name); END",
+]
+
+MAX_RESULTS = 500
+
+
+def extension(name):
+    return name.rsplit('.', 1)[1].lower() if '.' in name.strip('.') else ''
+
+
+def holds_folders(entry):
+    """
+    Whether the ``(is_dir, is_link, size)`` entry is a folder and not a link
+    to one.
+    """
+    return bool(entry[0] and not entry[1])
+
+
+def entry_usage(is_dir, is_link, size):
+    """
+    ``(bytes, folders)`` one entry counts for in the usage ledger.
+    """
+    if is_link:
+        return 0, 0
+    return (0, 1) if is_dir else (size, 0)
+
+
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SearchIndex(object):
+    """
+    Index of the names of the files and folders under a basepath, kept in an
+    SQLite database in the state directory. Paths are relative to the
+    basepath, start with '/' and have no trailing slash.
+
+    The index is built on the first search and then kept up to date by the
+    actions; updates are ignored while it has not been built.
+
+    Once built, the index is also the record changes to the usage ledger are
+    counted against: the updates return the ``(bytes, folders)`` they
+    changed in the index, the way measure() counts them. A change seen by
+    several updates, from actions or from the watchers of several
+    processes, is counted by the first one only.
+    """
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+
+    @property
+    def path(self):
+        return state_path(self.basepath, 'search.sqlite3')
+
+    @contextlib.contextmanager
+    def _connect(self, path=None, immediate=False):
+        connection = sqlite3.connect(path or self.path, timeout=30)
+        # so that rows replaced by INSERT OR REPLACE leave the names index
+        connection.execute('PRAGMA recursive_triggers = ON')
+        try:
+            with connection:
+                if immediate:
+                    # what is read to count a change is not changed by
+                    # another connection before the change is written
+                    connection.execute('BEGIN IMMEDIATE')
+                yield connection
+        finally:
+            connection.close()
+
+    def _built(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT value FROM meta WHERE key = 'built'"
+                ).fetchone()
+        except sqlite3.DatabaseError:
+            return False
+        return row is not None and row[0] == SCHEMA_VERSION
+
+    def _fts(self, connection):
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'fts'"
+        ).fetchone()
+        return row is not None and row[0] == '1'
+
+    def _row(self, path, entry):
+        return (
+            path,
+            entry.name,
+            entry.name.lower(),
+            '' if entry.is_dir else extension(entry.name),
+            1 if entry.is_dir else 0,
+            entry.size,
+            entry.mtime,
+            1 if entry.is_link else 0,
+        )
+
+    def _walk(self, relpath):
+        """
+        Rows for the entries under the folder ``relpath``.
+        """
+        stack = [relpath]
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = scan(self.basepath + folder)
+            except OSError:
+                continue
+            for entry in entries:
+                path = folder.rstrip('/') + '/' + entry.name
+                yield self._row(path, entry)
+                if entry.is_dir and not entry.is_link:
+                    stack.append(path)
+
+    def _insert(self, connection, rows):
+        connection.executemany(
+            'INSERT OR REPLACE INTO files'
+            ' (path, name, lname, ext, is_dir, size, mtime, is_link)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows,
+        )
+
+    def _usage(self, connection, path, parents=()):
+        """
+        ``(bytes, folders)`` recorded for ``path``, everything under it and
+        the folders ``parents``. Links are not counted, like in measure().
+        """
+        return connection.execute(
+            'SELECT'
+            ' coalesce(sum(CASE WHEN is_dir = 0 AND is_link = 0 THEN size ELSE 0 END), 0),'
+            ' coalesce(sum(CASE WHEN is_dir = 1 AND is_link = 0 THEN 1 ELSE 0 END), 0)'
+            ' FROM files WHERE path = ? OR (path > ? AND path < ?)'
+            ' OR path IN (%s)' % ', '.join('?' * len(parents)),
+            (path, path + '/', path + '0') + tuple(parents),
+        ).fetchone()
+
+    def rebuild(self):
+        """
+        Index the whole basepath into a new database and swap it in.
+        Returns the number of entries indexed.
+        """
+        tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.current_thread().ident)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with self._connect(tmp) as connection:
+            # nothing to lose if this fails halfway
+            connection.execute('PRAGMA synchronous = OFF')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._insert(connection, self._walk('/'))
+            for statement in INDEXES:
+                connection.execute(statement)
+            try:
+                for statement in FTS_SCHEMA:
+                    connection.execute(statement)
+                fts = '1'
+            except sqlite3.OperationalError:
+                fts = '0'
+            count = connection.execute('SELECT count(*) FROM files').fetchone()[0]
+            connection.executemany(
+                'INSERT INTO meta (key, value) VALUES (?, ?)',
+                [('built', SCHEMA_VERSION), ('fts', fts)],
+            )
+        os.rename(tmp, self.path)
+        return count
+
+    def _relpath(self, path):
+        return '/' + path.strip('/')
+
+    def add(self, *paths):
+        """
+        Index the files or folders ``paths``, everything under them and the
+        folders leading to them. Returns the usage added, None if the index
+        is not built.
+        """
+        if not self._built():
+            return None
+        bytes = folders = 0
+        with self._connect(immediate=True) as connection:
+            for path in paths:
+                path = self._relpath(path)
+                rows = []
+                parent = path
+                try:
+                    while parent != '/':
+                        rows.append(self._row(parent, self._entry(parent)))
+                        parent = os.path.dirname(parent)
+                except OSError:
+                    continue
+                parents = [row[0] for row in rows[1:]]
+                old_bytes, old_folders = self._usage(connection, path, parents)
+                self._insert(connection, rows)
+                if rows and rows[0][4] and not rows[0][7]:
+                    self._insert(connection, self._walk(path))
+                new_bytes, new_folders = self._usage(connection, path, parents)
+                bytes += new_bytes - old_bytes
+                folders += new_folders - old_folders
+        return bytes, folders
+
+    def _entry(self, path):
+        name = os.path.basename(path)
+        if is_temporary(name):
+            raise OSError('temporary file')
+        filepath = self.basepath + path
+        is_link = os.path.islink(filepath)
+        if os.path.isdir(filepath):
+            return Entry(name, True, is_link, 0, 0)
+        st = os.stat(filepath) if not is_link else os.lstat(filepath)
+        return Entry(name, False, is_link, st.st_size, st.st_mtime)
+
+    def remove(self, *paths):
+        """
+        Drop the files or folders ``paths`` and everything under them.
+        Returns the usage removed, as a negative delta, None if the index is
+        not built.
+        """
+        if not self._built():
+            return None
+        bytes = folders = 0
+        with self._connect(immediate=True) as connection:
+            for path in paths:
+                path = self._relpath(path)
+                removed_bytes, removed_folders = self._usage(connection, path)
+                self._delete(connection, path)
+                bytes -= removed_bytes
+                folders -= removed_folders
+        return bytes, folders
+
+    def _delete(self, connection, path):
+        connection.execute(
+            'DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)',
+            (path, path + '/', path + '0'),
+        )
+
+    def rename(self, old, new):
+        removed = self.remove(old)
+        added = self.add(new)
+        if removed is None or added is None:
+            return None
+        return removed[0] + added[0], removed[1] + added[1]
+
+    def refresh(self, *folders):
+        """
+        Bring the entries directly inside the folders ``folders`` in line
+        with the disk after they were changed by someone else, indexing new
+        subfolders completely. Returns the change of usage, None if the
+        index is not built.
+        """
+        if not self._built():
+            return None
+        added_bytes = added_folders = 0
+        with self._connect(immediate=True) as connection:
+            for folder in folders:
+                prefix = self._relpath(folder).rstrip('/') + '/'
+                indexed = dict(
+                    (path, (is_dir, is_link, size))
+                    for path, is_dir, is_link, size in connection.execute(
+                        'SELECT path, is_dir, is_link, size FROM files WHERE path > ? AND path < ?',
+                        (prefix, prefix[:-1] + '0'),
+                    )
+                    if '/' not in path[len(prefix):]
+                )
+                try:
+                    entries = scan(self.basepath + prefix)
+                except OSError:
+                    entries = []
+                rows = [self._row(prefix + entry.name, entry) for entry in entries]
+                present = dict((row[0], (row[4], row[7], row[5])) for row in rows)
+                # removed, or no longer a folder holding its subfolders
+                stale = [
+                    path for path, old in indexed.items()
+                    if path not in present or (holds_folders(old) and not holds_folders(present[path]))
+                ]
+                walked = [
+                    path for path, new in present.items()
+                    if holds_folders(new) and not (path in indexed and holds_folders(indexed[path]))
+                ]
+                # what is under the stale and walked entries is counted in
+                # the index, the other entries from the rows
+                for path in stale + walked:
+                    old_bytes, old_folders = self._usage(connection, path)
+                    added_bytes, added_folders = added_bytes - old_bytes, added_folders - old_folders
+                for path in stale:
+                    self._delete(connection, path)
+                self._insert(connection, rows)
+                for path in walked:
+                    self._insert(connection, self._walk(path))
+                    new_bytes, new_folders = self._usage(connection, path)
+                    added_bytes, added_folders = added_bytes + new_bytes, added_folders + new_folders
+                for path, new in present.items():
+                    if path in walked:
+                        continue
+                    new_bytes, new_folders = entry_usage(*new)
+                    added_bytes, added_folders = added_bytes + new_bytes, added_folders + new_folders
+                    if path in indexed and path not in stale:
+                        old_bytes, old_folders = entry_usage(*indexed[path])
+                        added_bytes, added_folders = added_bytes - old_bytes, added_folders - old_folders
+        return added_bytes, added_folders
+
+    def resync(self):
+        """
+        Rebuild the index if it has been built.
+        """
+        if self._built():
+            return self.rebuild()
+
+    def search(self, query='', mode='substring', ext=None, after=None,
+               limit=50):
+        """
+        Entries whose name starts with (mode 'prefix') or contains (mode
+        'substring') ``query``, ignoring case, optionally only the files
+        with the extension ``ext``. Results are ordered by name then path,
+        ``after`` is the last path of the previous page. Returns ``(results, next)``
+        where ``next`` is the ``after`` of the next page or None.
+        """
+        if not self._built():
+            self.rebuild()
+        limit = max(1, min(limit, MAX_RESULTS))
+        where = []
+        params = []
+        query = query.lower()
+        with self._connect() as connection:
+            if query and mode == 'prefix':
+                where.append('lname >= ? AND lname < ?')
+                params.extend([query, query + u'\uffff'])
+            elif query and len(query) >= 3 and self._fts(connection):
+                where.append('id IN (SELECT rowid FROM names WHERE names MATCH ?)')
+                params.append('"' + query.replace('"', '""') + '"')
+            elif query:
+                where.append("lname LIKE ? ESCAPE '\\'")
+                params.append('%' + like_escape(query) + '%')
+            if ext:
+                where.append('ext = ?')
+                params.append(ext.lower().lstrip('.'))
+            if after:
+                lname = os.path.basename(after).lower()
+                where.append('(lname > ? OR (lname = ? AND path > ?))')
+                params.extend([lname, lname, after])
+            sql = 'SELECT path, name, is_dir, size, mtime FROM files'
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            sql += ' ORDER BY lname, path LIMIT ?'
+            params.append(limit + 1)
+            rows = connection.execute(sql, params).fetchall()
+        results = [
+            {
+                'path': path,
+                'name': name,
+                'is_dir': bool(is_dir),
+                'size': size,
+                'mtime': mtime,
+            }
+            for path, name, is_dir, size, mtime in rows[:limit]
+        ]
+        next_after = results[-1]['path'] if len(rows) > limit else None
+        return results, next_after
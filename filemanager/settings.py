@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from django.conf import settings
 
@@ -22,3 +23,242 @@ FILEMANAGER_SHOW_SPACE = getattr(
     'FILEMANAGER_SHOW_SPACE',
     FILEMANAGER_CHECK_SPACE,
 )
+FILEMANAGER_STATE_ROOT = getattr(
+    settings,
+    'FILEMANAGER_STATE_ROOT',
+    os.path.join(tempfile.gettempdir(), 'django-filemanager'),
+)
+FILEMANAGER_LAZY_TREE = getattr(
+    settings,
+    'FILEMANAGER_LAZY_TREE',
+    False,
+)
+FILEMANAGER_LISTING_CACHE_SIZE = getattr(
+    settings,
+    'FILEMANAGER_LISTING_CACHE_SIZE',
+    200000,
+)
+FILEMANAGER_THUMBNAIL_CACHE_SIZE = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_CACHE_SIZE',
+    100*1024*1024,
+)
+# None, 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx)
+FILEMANAGER_SENDFILE = getattr(
+    settings,
+    'FILEMANAGER_SENDFILE',
+    None,
+)
+# for x-accel-redirect: files under FILEMANAGER_SENDFILE_ROOT are sent by
+# the internal location FILEMANAGER_SENDFILE_URL
+FILEMANAGER_SENDFILE_ROOT = getattr(
+    settings,
+    'FILEMANAGER_SENDFILE_ROOT',
+    '/',
+)
+FILEMANAGER_SENDFILE_URL = getattr(
+    settings,
+    'FILEMANAGER_SENDFILE_URL',
+    '/protected/',
+)
+# 'tar', 'tar.gz' or 'zip', can be overridden with ?format= on downloads
+FILEMANAGER_ARCHIVE_FORMAT = getattr(
+    settings,
+    'FILEMANAGER_ARCHIVE_FORMAT',
+    'tar.gz',
+)
+FILEMANAGER_ARCHIVE_COMPRESSLEVEL = getattr(
+    settings,
+    'FILEMANAGER_ARCHIVE_COMPRESSLEVEL',
+    6,
+)
+# copy, move and unzip actions involving more bytes than this run in the
+# background, None runs everything inline
+FILEMANAGER_JOB_THRESHOLD = getattr(
+    settings,
+    'FILEMANAGER_JOB_THRESHOLD',
+    64*1024*1024,
+)
+FILEMANAGER_JOB_WORKERS = getattr(
+    settings,
+    'FILEMANAGER_JOB_WORKERS',
+    4,
+)
+FILEMANAGER_JOB_PER_BASEPATH = getattr(
+    settings,
+    'FILEMANAGER_JOB_PER_BASEPATH',
+    1,
+)
+# seconds the status of a finished job stays available
+FILEMANAGER_JOB_TTL = getattr(
+    settings,
+    'FILEMANAGER_JOB_TTL',
+    3600,
+)
+# resumable uploads not written to for this many seconds are deleted
+FILEMANAGER_UPLOAD_EXPIRY = getattr(
+    settings,
+    'FILEMANAGER_UPLOAD_EXPIRY',
+    24*3600,
+)
+# size of the chunks the page sends files larger than that in, None to
+# always upload in a single request
+FILEMANAGER_UPLOAD_CHUNK_SIZE = getattr(
+    settings,
+    'FILEMANAGER_UPLOAD_CHUNK_SIZE',
+    8*1024*1024,
+)
+# archives expanding to more bytes than this (and than the space left when
+# FILEMANAGER_CHECK_SPACE is on) or compressed more than
+# FILEMANAGER_UNZIP_MAX_RATIO times are not extracted, None for no limit
+FILEMANAGER_UNZIP_MAX_SIZE = getattr(
+    settings,
+    'FILEMANAGER_UNZIP_MAX_SIZE',
+    None,
+)
+FILEMANAGER_UNZIP_MAX_RATIO = getattr(
+    settings,
+    'FILEMANAGER_UNZIP_MAX_RATIO',
+    100,
+)
+FILEMANAGER_UNZIP_WORKERS = getattr(
+    settings,
+    'FILEMANAGER_UNZIP_WORKERS',
+    4,
+)
+# folders with more files than this are not sent with the page, their
+# files are fetched one page at a time as they are scrolled, None to
+# always send every file
+FILEMANAGER_LIST_PAGE_SIZE = getattr(
+    settings,
+    'FILEMANAGER_LIST_PAGE_SIZE',
+    500,
+)
+# a callable, or its dotted path, called with (name, kind, value, labels)
+# for every metric, next to the metric_recorded signal
+FILEMANAGER_METRICS_HOOK = getattr(
+    settings,
+    'FILEMANAGER_METRICS_HOOK',
+    None,
+)
+# add a Server-Timing header with the duration of each phase of a request
+FILEMANAGER_SERVER_TIMING = getattr(
+    settings,
+    'FILEMANAGER_SERVER_TIMING',
+    settings.DEBUG,
+)
+# folder of the basepath files uploaded from CKEditor are saved in
+FILEMANAGER_QUICK_UPLOAD_PATH = getattr(
+    settings,
+    'FILEMANAGER_QUICK_UPLOAD_PATH',
+    '/',
+)
+# FileManager instances of the same basepath and extensions share their
+# usage ledger and search index; this many are kept, those unused for
+# FILEMANAGER_STATE_REGISTRY_TTL seconds are dropped
+FILEMANAGER_STATE_REGISTRY_SIZE = getattr(
+    settings,
+    'FILEMANAGER_STATE_REGISTRY_SIZE',
+    64,
+)
+FILEMANAGER_STATE_REGISTRY_TTL = getattr(
+    settings,
+    'FILEMANAGER_STATE_REGISTRY_TTL',
+    3600,
+)
+# watch the basepaths for changes made outside of the filemanager and update
+# the caches, the search index and the usage ledger: True uses inotify
+# when available and scans the tree every FILEMANAGER_WATCH_INTERVAL
+# seconds otherwise, 'poll' always scans
+FILEMANAGER_WATCH = getattr(
+    settings,
+    'FILEMANAGER_WATCH',
+    False,
+)
+# changes are applied together this many seconds after the first one
+FILEMANAGER_WATCH_DELAY = getattr(
+    settings,
+    'FILEMANAGER_WATCH_DELAY',
+    1,
+)
+FILEMANAGER_WATCH_INTERVAL = getattr(
+    settings,
+    'FILEMANAGER_WATCH_INTERVAL',
+    10,
+)
+# threads of AsyncFileManager for filesystem work and for thumbnails (None
+# for one per CPU)
+FILEMANAGER_ASYNC_IO_WORKERS = getattr(
+    settings,
+    'FILEMANAGER_ASYNC_IO_WORKERS',
+    16,
+)
+FILEMANAGER_ASYNC_IMAGE_WORKERS = getattr(
+    settings,
+    'FILEMANAGER_ASYNC_IMAGE_WORKERS',
+    None,
+)
+# answer repeated page loads with 304 Not Modified while the tree is
+# unchanged; changes made outside of the filemanager are only noticed with
+# FILEMANAGER_WATCH
+FILEMANAGER_PAGE_ETAG = getattr(
+    settings,
+    'FILEMANAGER_PAGE_ETAG',
+    bool(FILEMANAGER_WATCH),
+)
+# number of files whose type detected by libmagic is kept in memory
+FILEMANAGER_MIME_CACHE_SIZE = getattr(
+    settings,
+    'FILEMANAGER_MIME_CACHE_SIZE',
+    100000,
+)
+# thumbnails are made by a pool of this many processes (threads if
+# FILEMANAGER_THUMBNAIL_PROCESSES is False), those of the images of a
+# folder are started as soon as it is listed with FILEMANAGER_THUMBNAIL_PREFETCH
+FILEMANAGER_THUMBNAIL_WORKERS = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_WORKERS',
+    2,
+)
+FILEMANAGER_THUMBNAIL_PROCESSES = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_PROCESSES',
+    True,
+)
+FILEMANAGER_THUMBNAIL_PREFETCH = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_PREFETCH',
+    True,
+)
+# seconds a request waits for its thumbnail before the icon of the file
+# type is sent instead, None to wait as long as it takes
+FILEMANAGER_THUMBNAIL_TIMEOUT = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_TIMEOUT',
+    30,
+)
+# thumbnail sizes, in pixels, a media url can ask for with ?size=<name>;
+# FILEMANAGER_THUMBNAIL_PRESET is used without it
+FILEMANAGER_THUMBNAIL_PRESETS = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_PRESETS',
+    {'small': 60, 'medium': 200, 'large': 800},
+)
+FILEMANAGER_THUMBNAIL_PRESET = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_PRESET',
+    'small',
+)
+# thumbnails are encoded in the first of these formats the Accept header
+# of the browser names, else in the format of the image; ?format= picks
+# one explicitly
+FILEMANAGER_THUMBNAIL_FORMATS = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_FORMATS',
+    ['webp'],
+)
+FILEMANAGER_THUMBNAIL_QUALITY = getattr(
+    settings,
+    'FILEMANAGER_THUMBNAIL_QUALITY',
+    {'webp': 80, 'jpeg': 85},
+)
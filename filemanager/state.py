@@ -0,0 +1,94 @@
+import collections
+import threading
+import time
+
+from . import settings
+from .generation import TreeGeneration
+from .ledger import UsageLedger
+from .listing import listing_cache
+from .mime import allowed_types
+from .search import SearchIndex
+from .watcher import unwatch, watch
+
+
+class State(object):
+    """
+    What a FileManager of one basepath and configuration can reuse from one
+    request to the next. The objects are safe to share between threads.
+    """
+
+    def __init__(self, basepath, extensions):
+        self.basepath = basepath
+        self.extensions = extensions
+        self.allowed_types = allowed_types(extensions)
+        self.usage = UsageLedger(basepath)
+        self.search_index = SearchIndex(basepath)
+        self.generation = TreeGeneration(basepath)
+        self.last_used = time.time()
+
+
+class StateRegistry(object):
+    """
+    Process wide LRU registry of the State of each basepath and
+    configuration. States unused for ``ttl`` seconds, or the least recently
+    used ones beyond ``max_states``, are evicted: the listings of their
+    basepath are dropped from the listing cache and it is no longer
+    watched.
+    """
+
+    def __init__(self, max_states, ttl):
+        self.max_states = max_states
+        self.ttl = ttl
+        self._states = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, basepath, extensions=None):
+        key = (basepath, tuple(extensions) if extensions else None)
+        now = time.time()
+        with self._lock:
+            state = self._states.pop(key, None)
+            if state is None:
+                state = State(basepath, list(key[1]) if key[1] else None)
+            state.last_used = now
+            self._states[key] = state
+            evicted = self._evict(now)
+        self._release(evicted)
+        if settings.FILEMANAGER_WATCH:
+            watch(basepath)
+        return state
+
+    def _evict(self, now):
+        evicted = []
+        for key, state in list(self._states.items()):
+            if len(self._states) <= self.max_states and (
+                    not self.ttl or now - state.last_used <= self.ttl):
+                # the states are ordered from the least recently used
+                break
+            evicted.append(self._states.pop(key))
+        return evicted
+
+    def _release(self, evicted):
+        with self._lock:
+            in_use = set(key[0] for key in self._states)
+        for basepath in set(state.basepath for state in evicted) - in_use:
+            listing_cache.invalidate_tree(basepath)
+            unwatch(basepath)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._states.values())
+            self._states.clear()
+        self._release(evicted)
+
+    def __len__(self):
+        return len(self._states)
+
+
+state_registry = StateRegistry(
+    settings.FILEMANAGER_STATE_REGISTRY_SIZE,
+    settings.FILEMANAGER_STATE_REGISTRY_TTL,
+)
+
+
+def get_state(basepath, extensions=None):
+    return state_registry.get(basepath, extensions)
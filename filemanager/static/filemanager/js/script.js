@@ -1,6 +1,45 @@
 var action,type;
 var selected_dir_id,selected_file;
 var zclip = false;
+var list_next = null;
+var dir_structure = decode_tree(tree);
+var thumbnail_format = pick_thumbnail_format(thumbnail_formats);
+
+// The first of the formats the server prefers for the thumbnails that the
+// browser can show, else 'original'. The thumbnails are asked in it, and
+// it is kept in a cookie for the server to make them ahead in it.
+function pick_thumbnail_format(formats)
+{ var canvas = document.createElement('canvas');
+  canvas.width = canvas.height = 1;
+  var format = 'original';
+  for(var i = 0; i < formats.length; i++)
+  { if(formats[i] != 'webp' || (canvas.toDataURL &&
+        canvas.toDataURL('image/webp').indexOf('data:image/webp') == 0))
+    { format = formats[i];
+      break;
+    }
+  }
+  document.cookie = 'filemanager_thumbnail_format='+format+'; path=/; SameSite=Lax';
+  return format;
+}
+
+// The page sends the tree in columns (see filemanager/tree.py), node i
+// has the id i+1 and comes after its parent.
+function decode_tree(tree)
+{ var nodes = [];
+  for(var i = 0; i < tree['parent'].length; i++)
+  { var flags = tree['flags'][i];
+    var node = {'id':i+1,'open':(flags & 1)?'yes':'no','dirs':{},'files':[]};
+    if(flags & 2)node['loaded'] = 'no';
+    if(flags & 4)node['paged'] = 'yes';
+    for(var j = 0; j < tree['files'][i].length; j++)
+      node['files'].push(tree['names'][tree['files'][i][j]]);
+    nodes.push(node);
+    if(tree['parent'][i] >= 0)
+      nodes[tree['parent'][i]]['dirs'][tree['names'][tree['name'][i]]] = node;
+  }
+  return {'':nodes[0]};
+}
 
 function get_human_string(val)
 {
@@ -36,6 +75,13 @@ function onload(){
   else
      $('#message').html('Hint : Use right click to add,rename or delete files and folders');
   $('#ufile').change(function(){form_submit('upload','file');});
+  $('#content').scroll(function(){
+    if(list_next && this.scrollTop + $(this).innerHeight() >= this.scrollHeight - 200)
+    { var after = list_next;
+      list_next = null;
+      load_page(dir_id, after);
+    }
+  });
   if($.browser.mozilla) {
     moz_major_ver = (+($.browser.version.split(".")[0]))
     if(moz_major_ver < 23){
@@ -45,10 +91,171 @@ function onload(){
       });
     }
   }
+  update_space();
+  for(var j in jobs)
+    poll_job(jobs[j]);
+}
+
+function update_space()
+{
   $('#space_quota').width(((space_consumed*100)/max_space).toString()+'%');
   $('#space_quota_string').html(get_human_string(space_consumed) + ' of ' + get_human_string(max_space) + ' used');
 }
 
+// Performs the action set up in #form through ?action and applies the
+// changes it returns to the tree instead of reloading the page.
+function submit_action()
+{
+  if(!window.FormData)
+  { $('#submit').trigger('click');
+    return;
+  }
+  $('#message').html('Working...');
+  $.ajax({url: './?action', type: 'POST', data: new FormData($('#form')[0]),
+          processData: false, contentType: false, dataType: 'json'})
+  .done(function(data){
+    $('#message').html(data['messages'].length>0?data['messages'][0]:'');
+    space_consumed = data['space_consumed'];
+    update_space();
+    apply_delta(data['delta']);
+    for(var j in data['jobs'])
+      poll_job(data['jobs'][j], data['changed']);
+  })
+  .fail(function(){$('#message').html('ERROR : The action failed');})
+  .always(function(){$('#ufile').val('');});
+}
+
+function get_dir_by_path(path)
+{ var dir = dir_structure[''];
+  var parts = path.split('/');
+  for(var i = 0; i < parts.length; i++)
+  { if(parts[i] == '')continue;
+    dir = dir['dirs'][parts[i]];
+    if(!dir)return null;
+  }
+  return dir;
+}
+
+// Replaces the content of the folders in delta (as returned by ?tree, with
+// their path), keeping the nodes and ids of the folders still there.
+function apply_delta(delta)
+{ var next_id = max_dir_id(dir_structure);
+  for(var i = 0; i < delta.length; i++)
+  { var dir = get_dir_by_path(delta[i]['path']);
+    if(dir == null || dir['loaded'] == 'no')continue;
+    var dirs = {};
+    for(var j = 0; j < delta[i]['dirs'].length; j++)
+    { var name = delta[i]['dirs'][j];
+      dirs[name] = dir['dirs'][name];
+      if(!dirs[name] || delta[i]['deep'])
+        dirs[name] = {'id':dirs[name]?dirs[name]['id']:++next_id,'open':'no','loaded':'no','dirs':{},'files':[]};
+    }
+    dir['dirs'] = dirs;
+    dir['files'] = delta[i]['files'];
+    if(delta[i]['paged'])dir['paged'] = 'yes';
+    else delete dir['paged'];
+  }
+  if(get_dir(dir_id) == null)dir_id = 1;
+  refresh_dirs();
+  render_files(dir_id);
+}
+
+function refresh_folders(paths)
+{
+  $.each(paths, function(i, path){
+    $.getJSON('.'+path+'?tree', function(data){
+      data['path'] = path;
+      apply_delta([data]);
+    });
+  });
+}
+
+function poll_job(id, changed)
+{
+  $.getJSON('./?job='+id, function(job){
+    if(job['status']=='queued' || job['status']=='running')
+    {
+      var status = job['action']+' : '+job['status'];
+      if(job['bytes_total'])
+        status += ' '+Math.floor(job['bytes_done']*100/job['bytes_total'])+'%';
+      if(job['eta'] != null)
+        status += ', '+job['eta']+'s left';
+      $('#message').html(status);
+      setTimeout(function(){poll_job(id, changed);},1000);
+      return;
+    }
+    $('#message').html(job['messages'].length>0?job['messages'][0]:job['action']+' completed');
+    if(changed)
+      refresh_folders(changed);
+    else
+      setTimeout(function(){window.location.href = window.location.href;},3000);
+  });
+}
+
+function upload_error(xhr)
+{
+  try { return $.parseJSON(xhr.responseText); }
+  catch(e) { return {'error': 'Upload failed'}; }
+}
+
+// Sends large files in chunks of upload_chunk_size, asking the server for
+// the offset to resume from when a chunk fails.
+function resumable_upload(files, path)
+{
+  var csrf = $('#form input[name=csrfmiddlewaretoken]').val();
+  var results = [];
+  function next(i)
+  {
+    if(i >= files.length)
+    {
+      $('#message').html(results.length>0?results[0]:'All files uploaded successfully');
+      $('#ufile').val('');
+      refresh_folders([path]);
+      return;
+    }
+    var file = files[i];
+    $.ajax({url: './?upload', type: 'POST', dataType: 'json', headers: {'X-CSRFToken': csrf},
+            data: {'name': file.name, 'size': file.size, 'path': path}})
+    .done(function(upload){send(file, upload['id'], 0, 0, function(){next(i+1);});})
+    .fail(function(xhr){results.push(upload_error(xhr)['error']);next(i+1);});
+  }
+  function send(file, id, offset, retries, finished)
+  {
+    if(offset >= file.size)
+    {
+      $.ajax({url: './?upload='+id+'&finalize', type: 'POST', dataType: 'json', headers: {'X-CSRFToken': csrf}})
+      .done(function(r){finished();})
+      .fail(function(xhr){
+        var r = upload_error(xhr);
+        results.push(r['messages']?r['messages'][0]:r['error']);
+        finished();
+      });
+      return;
+    }
+    $('#message').html('Uploading '+file.name+' '+Math.floor(offset*100/file.size)+'%');
+    $.ajax({url: './?upload='+id, type: 'PATCH', dataType: 'json', processData: false,
+            contentType: 'application/offset+octet-stream',
+            headers: {'X-CSRFToken': csrf, 'Upload-Offset': offset},
+            data: file.slice(offset, Math.min(offset+upload_chunk_size, file.size))})
+    .done(function(r){send(file, id, r['offset'], 0, finished);})
+    .fail(function(xhr){
+      if(retries >= 5)
+      {
+        results.push('Upload failed : '+file.name);
+        $.ajax({url: './?upload='+id, type: 'DELETE', headers: {'X-CSRFToken': csrf}});
+        finished();
+        return;
+      }
+      setTimeout(function(){
+        $.getJSON('./?upload='+id)
+        .done(function(r){send(file, id, r['offset'], retries+1, finished);})
+        .fail(function(){send(file, id, offset, retries+1, finished);});
+      }, 1000*(retries+1));
+    });
+  }
+  next(0);
+}
+
 $('body').ready(onload);
 $(window).resize(size);
 
@@ -93,11 +300,37 @@ function get_path(id,ds,basepath)
  else return null;
 }
 
+function max_dir_id(ds)
+{var max = 0;
+ for(var d in ds)
+ { max = Math.max(max, ds[d]['id'], max_dir_id(ds[d]['dirs']));
+ }
+ return max;
+}
+
+function load_dir(id,callback)
+{var dir = get_dir(id);
+ if(dir['loaded']!='no')
+ { callback();
+   return;
+ }
+ $.getJSON('.'+get_path(id)+'?tree', function(data){
+   var next_id = max_dir_id(dir_structure);
+   dir['dirs'] = {};
+   for(var i in data['dirs'])
+     dir['dirs'][data['dirs'][i]] = {'id':++next_id,'open':'no','loaded':'no','dirs':{},'files':[]};
+   dir['files'] = data['files'];
+   if(data['paged'])dir['paged'] = 'yes';
+   delete dir['loaded'];
+   callback();
+ });
+}
+
 function change_sign(id)
 {d = get_dir(id);
  if(d['open']=='yes')d['open']='no';
  else d['open']='yes';
- refresh_dirs();
+ load_dir(id, refresh_dirs);
 }
 
 function CKEditorRepy(filename)
@@ -107,6 +340,10 @@ function CKEditorRepy(filename)
 }
 
 function show_files(id)
+{ load_dir(id, function(){ render_files(id); });
+}
+
+function render_files(id)
 { dir_id = id;
   var dirs = [];
   var dir_list = get_dir(id)['dirs'];
@@ -124,6 +361,7 @@ function show_files(id)
             return 0;
           });
   $('#content').html('');
+  list_next = null;
   for(d in dirs)
   {
     $('#content').append("<div class='file' title='"+dirs[d]['name']+"'"+
@@ -131,18 +369,42 @@ function show_files(id)
        "<div style=\"background-image:url('"+static_url+"filemanager/images/folder_big.png');\" width='100%' height='100%' ></div></div>"+
        "<div class='filename'>"+dirs[d]['name']+"</div></div>\n");
   }
+  if(get_dir(id)['paged']=='yes')
+    load_page(id, null);
   for(f in files)
-  { var ext = files[f].split('.')[(files[f].split('.').length-1)];
-    $('#content').append("<div class='file' title='"+escape(files[f])+"'"+
-       "onmousedown='rightclick_handle(event,\""+escape(files[f])+"\",\"file\");'><div class='thumbnail'>"+
-       "<div style=\"background-image:url('"+get_path(id).substr(1)+escape(files[f])+"');\" width='100%' height='100%' ></div></div>"+
-       "<div class='filename'>"+files[f]+"</div></div>\n");
-  }
+    $('#content').append(file_html(id, files[f]));
   $('#status').html(get_path(id))
   $('.current_directory').removeClass('current_directory');
   $('#'+dir_id).addClass('current_directory');
 }
 
+function file_html(id, file)
+{
+  return "<div class='file' title='"+escape(file)+"'"+
+       "onmousedown='rightclick_handle(event,\""+escape(file)+"\",\"file\");'><div class='thumbnail'>"+
+       "<div style=\"background-image:url('"+get_path(id).substr(1)+escape(file)+"?format="+thumbnail_format+"');\" width='100%' height='100%' ></div></div>"+
+       "<div class='filename'>"+file+"</div></div>\n";
+}
+
+// Appends the next page of files of a folder with too many files to be
+// sent with the page, more pages are loaded as #content is scrolled.
+function load_page(id, after)
+{ var url = '.'+get_path(id)+'?list&limit='+list_page_size;
+  if(after)url += '&after='+encodeURIComponent(after);
+  $.getJSON(url, function(data){
+    if(id != dir_id)return;
+    for(var i in data['entries'])
+      if(!data['entries'][i]['is_dir'])
+        $('#content').append(file_html(id, data['entries'][i]['name']));
+    list_next = data['next'];
+    var content = $('#content')[0];
+    if(list_next && content.scrollHeight <= $('#content').innerHeight())
+    { list_next = null;
+      load_page(id, data['next']);
+    }
+  });
+}
+
 function show_directories(ds)
 { var html = "";
   for(d in ds)
@@ -151,7 +413,7 @@ function show_directories(ds)
      var id = ds[d]['id'];
      var sign;
      sign = (ds[d]['open']=='yes'?'[-]':'[+]');
-     var empty = true;
+     var empty = (ds[d]['loaded']!='no');
      for(i in ds[d]['dirs']){empty=false;break;}
      if(empty)sign = '';
      html+="<div class='directory "+(id==dir_id?'current_directory':'')+"' id='"+id+"'><div class='directory-sign' onclick='change_sign("+id+")'>"+sign+"</div>"+
@@ -346,7 +608,9 @@ function form_submit(action,type,value){
     $('#file_or_dir').val(clipboard['type']);
     $('#path').val(clipboard['path']);
     $('#current_path').val(get_path(selected_dir_id));
-    $('#submit').trigger('click');
+    // what was cut can only be pasted once
+    clipboard['empty'] = true;
+    submit_action();
   }
   if(action == 'copy')
   {
@@ -355,36 +619,44 @@ function form_submit(action,type,value){
     $('#path').val(clipboard['path']);
     if(type == 'dom')$('#current_path').val(get_path(dir_id));
     if(type == 'dir')$('#current_path').val(get_path(selected_dir_id));
-    $('#submit').trigger('click');
+    submit_action();
   }
   if(action == 'upload')
-  { $('#action').val('upload');
-    $('#submit').trigger('click');
+  { var files = $('#ufile')[0].files;
+    if(upload_chunk_size && files && window.Blob && Blob.prototype.slice)
+    { for(var i = 0; i < files.length; i++)
+        if(files[i].size > upload_chunk_size)
+        { resumable_upload(files, get_path(dir_id));
+          return;
+        }
+    }
+    $('#action').val('upload');
+    submit_action();
   }
   else if(action == 'add')
   { if(type == 'dom')$('#path').val(get_path(dir_id));
     if(type == 'dir')$('#path').val(get_path(selected_dir_id));
     $('#action').val('add');
     $('#name').val(value);
-    $('#submit').trigger('click');
+    submit_action();
   }
   else if(action == 'rename')
   { if(type == 'dir')$('#path').val(get_path(selected_dir_id));
     if(type == 'file')$('#path').val(get_path(dir_id)+selected_file);
     $('#action').val('rename');
     $('#name').val(value);
-    $('#submit').trigger('click');
+    submit_action();
   }
   else if(action == 'delete')
   { if(type == 'dir')$('#path').val(get_path(selected_dir_id));
     if(type == 'file')$('#path').val(get_path(dir_id)+selected_file);
     $('#action').val('delete');
-    $('#submit').trigger('click');
+    submit_action();
   }
   else if(action == 'unzip')
   { // if(type == 'dir')$('#path').val(get_path(selected_dir_id));
     if(type == 'file')$('#path').val(get_path(dir_id)+selected_file);
     $('#action').val('unzip');
-    $('#submit').trigger('click');
+    submit_action();
   }
 }
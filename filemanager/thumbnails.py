@@ -0,0 +1,322 @@
+import collections
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:  # the futures backport of Python 2
+    BrokenProcessPool = RuntimeError
+
+from . import settings
+from .conditional import make_etag
+
+THUMBNAIL_SIZE = 60
+
+ICONS_DIR = settings.FILEMANAGER_STATIC_ROOT + 'images/icons/'
+
+# Cache hits only refresh the access time of an entry this often.
+TOUCH_INTERVAL = 60
+
+
+class ThumbnailCache(object):
+    """
+    On-disk cache of encoded thumbnails shared by all basepaths.
+
+    Entries are named after a key that covers the source path, mtime and
+    size and the thumbnail size, so a changed source simply misses. The
+    mtime of an entry records its last use; when the cache grows over
+    ``max_bytes`` the least recently used entries are removed.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+                os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def has(self, key):
+        return bool(self.max_bytes) and os.path.exists(self._path(key))
+
+    def set(self, key, data):
+        if not self.max_bytes or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def _evict(self):
+        # Evict down to 90% of the limit so that eviction isn't triggered
+        # again by the next write.
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        size = sum(e[2] for e in entries)
+        target = self.max_bytes * 0.9
+        for path, mtime, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+        self._size = size
+
+
+thumbnail_cache = ThumbnailCache(
+    os.path.join(settings.FILEMANAGER_STATE_ROOT, 'thumbnails'),
+    settings.FILEMANAGER_THUMBNAIL_CACHE_SIZE,
+)
+
+
+def thumbnail_format(mimetype, ext):
+    """
+    The PIL format to encode the thumbnail of a file in.
+    """
+    return mimetype.split('/')[1] if mimetype else ext.upper()
+
+
+# what ?format= may ask for, 'original' is the format of the image
+OUTPUT_FORMATS = ('webp', 'jpeg', 'png')
+ORIGINAL_FORMAT = 'original'
+
+# script.js keeps the format it asks the thumbnails in here, so that the
+# thumbnails are made ahead in that format
+FORMAT_COOKIE = 'filemanager_thumbnail_format'
+
+
+def can_encode(format):
+    Image.init()
+    return format.upper() in Image.SAVE
+
+
+def make_thumbnail(filepath, format, size=THUMBNAIL_SIZE, quality=None):
+    """
+    Encoded thumbnail of the image at ``filepath``. JPEG images are decoded
+    at a reduced scale with draft() instead of at full size.
+    """
+    img = Image.open(filepath)
+    img.draft(img.mode, (size, size))
+    img.thumbnail((size, size), Image.LANCZOS)
+    format = format.upper()
+    if format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    elif format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or 'A' in img.mode else 'RGB')
+    options = {'quality': quality} if quality else {}
+    output = io.BytesIO()
+    img.save(output, format, **options)
+    return output.getvalue()
+
+
+class ThumbnailPool(object):
+    """
+    Bounded pool of worker processes (or threads) making the thumbnails,
+    in front of the thumbnail cache. A thumbnail requested while it is
+    being made waits for that job, so each one is only made once. When a
+    worker process dies (out of memory, a crashing decoder) the jobs of the
+    pool fail and new processes are started for the next ones. Waiting for
+    a thumbnail gives up after ``timeout`` seconds.
+    """
+
+    def __init__(self, workers, processes=True, max_pending=None, timeout=None):
+        self.workers = workers
+        self.processes = processes
+        self.timeout = timeout
+        self.max_pending = max_pending or workers * 64
+        self._pending = {}
+        self._executor = None
+        # the callback of a job that is already done runs right away
+        self._lock = threading.RLock()
+
+    def _start(self):
+        if self.processes:
+            return ProcessPoolExecutor(self.workers)
+        return ThreadPoolExecutor(self.workers)
+
+    def _restart(self):
+        # with self._lock held
+        self._executor.shutdown(wait=False)
+        self._executor = self._start()
+        for future in list(self._pending.values()):
+            if not future.done():
+                try:
+                    future.set_exception(BrokenProcessPool('A thumbnail worker died'))
+                except Exception:
+                    # finished in the meantime
+                    pass
+        self._pending.clear()
+
+    def _submit(self, key, filepath, *args):
+        # with self._lock held
+        if self._executor is None:
+            self._executor = self._start()
+        try:
+            future = self._executor.submit(make_thumbnail, filepath, *args)
+        except BrokenProcessPool:
+            self._restart()
+            future = self._executor.submit(make_thumbnail, filepath, *args)
+        self._pending[key] = future
+
+        def done(future):
+            if future.exception() is None:
+                thumbnail_cache.set(key, future.result())
+            with self._lock:
+                self._pending.pop(key, None)
+
+        future.add_done_callback(done)
+        return future
+
+    def get(self, key, filepath, format, size=THUMBNAIL_SIZE, quality=None):
+        """
+        The thumbnail ``key`` of ``filepath`` from the cache, from the job
+        making it or from a new job. Raises TimeoutError when the job takes
+        longer than the timeout of the pool; the job keeps running for the
+        next request.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+        if future is None:
+            data = thumbnail_cache.get(key)
+            if data is not None:
+                return data
+            with self._lock:
+                future = self._pending.get(key) or self._submit(
+                    key, filepath, format, size, quality,
+                )
+        return future.result(self.timeout)
+
+    def prefetch(self, key, filepath, format, size=THUMBNAIL_SIZE, quality=None):
+        """
+        Make the thumbnail ``key`` in the background unless it is cached,
+        already being made or too many are waiting.
+        """
+        if thumbnail_cache.has(key):
+            return
+        with self._lock:
+            if key not in self._pending and len(self._pending) < self.max_pending:
+                try:
+                    self._submit(key, filepath, format, size, quality)
+                except Exception:
+                    # only a head start, get() makes the thumbnail anyway
+                    pass
+
+
+_thumbnail_pool = None
+_thumbnail_pool_lock = threading.Lock()
+
+
+def thumbnail_pool():
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        with _thumbnail_pool_lock:
+            if _thumbnail_pool is None:
+                _thumbnail_pool = ThumbnailPool(
+                    settings.FILEMANAGER_THUMBNAIL_WORKERS,
+                    settings.FILEMANAGER_THUMBNAIL_PROCESSES,
+                    timeout=settings.FILEMANAGER_THUMBNAIL_TIMEOUT,
+                )
+    return _thumbnail_pool
+
+
+def resize(img, size=THUMBNAIL_SIZE):
+    """
+    Scale ``img`` down so that it fits in a ``size`` square.
+    """
+    width, height = img.size
+    mx = max([width, height])
+    w, h = width, height
+    if mx > size:
+        w = int(width*size/mx)
+        h = int(height*size/mx)
+    return img.resize((w, h), Image.LANCZOS)
+
+
+Icon = collections.namedtuple('Icon', ['data', 'etag', 'mtime'])
+
+_icons = {}
+_icon_names = None
+_icons_lock = threading.Lock()
+
+
+def _load_icon(name):
+    imagepath = ICONS_DIR + name + '.png'
+    mtime = os.stat(imagepath).st_mtime
+    output = io.BytesIO()
+    resize(Image.open(imagepath)).save(output, 'png')
+    return Icon(
+        output.getvalue(),
+        make_etag('icon', name, THUMBNAIL_SIZE, mtime),
+        mtime,
+    )
+
+
+def get_icon(ext):
+    """
+    The PNG icon shown for files with extension ``ext``. Icons are decoded,
+    resized and encoded once per process and then served from memory.
+    """
+    global _icon_names
+    icon = _icons.get(ext)
+    if icon is not None:
+        return icon
+    with _icons_lock:
+        if _icon_names is None:
+            _icon_names = set(
+                f[:-len('.png')]
+                for f in os.listdir(ICONS_DIR)
+                if f.endswith('.png')
+            )
+        name = ext if ext in _icon_names else 'default'
+        icon = _icons.get(name)
+        if icon is None:
+            icon = _icons[name] = _load_icon(name)
+    return icon
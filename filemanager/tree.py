@@ -0,0 +1,58 @@
+import json
+
+# bits of the flags of a node
+OPEN = 1
+NOT_LOADED = 2
+PAGED = 4
+
+
+def encode_tree(dir_structure):
+    """
+    Columnar form of a tree built by FileManager.directory_structure():
+    node ``i`` has the id ``i + 1``, its parent is ``parent[i]`` (-1 for the
+    root), its name is ``names[name[i]]``, its files are the names indexed
+    by ``files[i]`` and ``flags[i]`` holds OPEN, NOT_LOADED and PAGED. Names
+    are stored once however often they occur.
+    """
+    names = []
+    indexes = {}
+
+    def intern(name):
+        if name not in indexes:
+            indexes[name] = len(names)
+            names.append(name)
+        return indexes[name]
+
+    nodes = []
+    stack = [(-1, '', dir_structure[''])]
+    while stack:
+        parent, name, node = stack.pop()
+        nodes.append((node['id'], parent, name, node))
+        for d, child in node['dirs'].items():
+            stack.append((node['id'] - 1, d, child))
+    nodes.sort(key=lambda n: n[0])
+    tree = {'names': names, 'parent': [], 'name': [], 'flags': [], 'files': []}
+    for i, (id, parent, name, node) in enumerate(nodes):
+        if id != i + 1:
+            raise ValueError('The node ids are not consecutive')
+        tree['parent'].append(parent)
+        tree['name'].append(intern(name))
+        tree['flags'].append(
+            (OPEN if node['open'] == 'yes' else 0)
+            | (NOT_LOADED if node.get('loaded') == 'no' else 0)
+            | (PAGED if node.get('paged') == 'yes' else 0)
+        )
+        tree['files'].append([intern(f) for f in node['files']])
+    return tree
+
+
+def script_json(data):
+    """
+    ``data`` as JSON that can be put inside a <script> element.
+    """
+    return (
+        json.dumps(data, separators=(',', ':'))
+        .replace('<', '\\u003c')
+        .replace('>', '\\u003e')
+        .replace('&', '\\u0026')
+    )
@@ -0,0 +1,97 @@
+import errno
+import os
+import re
+import uuid
+
+from .mime import allowed_types
+from .utils import TEMP_PREFIX
+
+CHUNK_SIZE = 64*1024
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    return iter(lambda: fileobj.read(chunk_size), b'')
+
+
+def type_allowed(data, extensions):
+    """
+    Whether content starting with ``data`` is of a type matching one of
+    ``extensions``. libmagic only needs the first bytes of a file, so the
+    first chunk of an upload is enough. Anything is allowed without an
+    extensions list.
+    """
+    return allowed_types(extensions).allows_data(data)
+
+
+def save_chunks(chunks, filepath):
+    """
+    Write ``chunks`` to a temporary file next to ``filepath`` and rename it
+    into place once complete, so a partial file is never visible under its
+    final name. Returns the number of bytes written.
+    """
+    tmp = os.path.join(
+        os.path.dirname(filepath),
+        TEMP_PREFIX + uuid.uuid4().hex,
+    )
+    size = 0
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+                size += len(chunk)
+        # replaces the empty file left by reserve_name()
+        os.rename(tmp, filepath)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return size
+
+
+def reserve_name(folder, name):
+    """
+    Create an empty file named ``name`` in ``folder`` or, if that name is
+    taken, ``<name>.<n><.ext>`` with ``n`` past the highest suffix in use.
+    The file is created with O_CREAT | O_EXCL so that concurrent uploads
+    never get the same name; it is then replaced by the upload. Returns the
+    name reserved.
+    """
+    if '.' in name:
+        stem, ext = name[:name.rfind('.')], name[name.rfind('.'):]
+    else:
+        stem, ext = name, ''
+    candidate = name
+    suffix = None
+    while True:
+        try:
+            fd = os.open(
+                os.path.join(folder, candidate),
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                0o666,
+            )
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if suffix is None:
+                suffix = next_suffix(folder, stem, ext)
+            else:
+                # taken by a concurrent upload since the folder was read
+                suffix += 1
+            candidate = '%s.%d%s' % (stem, suffix, ext)
+            continue
+        os.close(fd)
+        return candidate
+
+
+def next_suffix(folder, stem, ext):
+    """
+    One more than the highest ``n`` of the ``<stem>.<n><ext>`` files of
+    ``folder``, from a single listing.
+    """
+    pattern = re.compile(re.escape(stem) + r'\.(\d+)' + re.escape(ext) + '$')
+    suffixes = [
+        int(match.group(1))
+        for match in map(pattern.match, os.listdir(folder))
+        if match
+    ]
+    return max(suffixes) + 1 if suffixes else 0
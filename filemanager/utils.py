@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+from . import settings
+
+# Files being written are named with this prefix until they are complete
+# and renamed into place; listings and usage counts skip them.
+TEMP_PREFIX = '.filemanager-'
+
+
+def state_dir(basepath):
+    """
+    Directory holding the sidecar state kept for ``basepath`` (usage ledger,
+    caches, indexes). It lives under FILEMANAGER_STATE_ROOT so that it never
+    shows up inside the managed tree.
+    """
+    key = hashlib.sha1(os.path.abspath(basepath).encode('utf-8')).hexdigest()
+    return os.path.join(settings.FILEMANAGER_STATE_ROOT, key)
+
+
+def state_path(basepath, name):
+    """
+    Path of the sidecar file ``name`` for ``basepath``, creating its
+    directory if needed.
+    """
+    directory = state_dir(basepath)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return os.path.join(directory, name)
+
+
+def is_temporary(name):
+    return name.startswith(TEMP_PREFIX)
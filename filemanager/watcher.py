@@ -0,0 +1,286 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from . import settings
+from .generation import TreeGeneration
+from .ledger import UsageLedger
+from .listing import listing_cache, scan
+from .search import SearchIndex
+from .utils import is_temporary
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):  # not Linux
+    _libc = None
+
+INOTIFY = _libc is not None
+
+
+class WatchLimitReached(Exception):
+    """
+    No more inotify watches can be added (fs.inotify.max_user_watches).
+    """
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+
+def _decode(name):
+    if str is bytes:
+        return name
+    return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def apply_changes(basepath, folders, resync=False):
+    """
+    Bring the caches of ``basepath`` in line with the disk after the folders
+    ``folders`` (relative to basepath) were changed, or after anything may
+    have changed if ``resync``.
+
+    The usage ledger is updated with the change the search index records
+    while it refreshes the folders, so changes already counted by the
+    action that made them or by the watcher of another process are not
+    counted again. The index is built, and the ledger rebuilt, the first
+    time and on resync only.
+    """
+    search_index = SearchIndex(basepath)
+    usage = UsageLedger(basepath)
+    delta = None
+    if resync:
+        listing_cache.invalidate_tree(basepath)
+    else:
+        for folder in folders:
+            path = basepath + folder.rstrip('/')
+            listing_cache.invalidate(path)
+            listing_cache.invalidate(path + '/')
+        delta = search_index.refresh(*folders)
+    if delta is None:
+        search_index.rebuild()
+        usage.rebuild()
+    else:
+        usage.update(*delta)
+    TreeGeneration(basepath).bump()
+
+
+class Watcher(threading.Thread):
+    """
+    Thread watching the tree of ``basepath`` for changes made outside of
+    the filemanager. It uses inotify when available and otherwise, or once
+    the watch limit is reached, compares a scan of the tree every
+    ``interval`` seconds.
+
+    Changes are collected for ``delay`` seconds before being applied, so a
+    storm of events costs a single apply_changes() call. When events are
+    lost (inotify queue overflow, watch limit) everything is resynced.
+    """
+
+    def __init__(self, basepath, delay=1, interval=10, polling=False):
+        threading.Thread.__init__(self, name='filemanager-watcher')
+        self.daemon = True
+        self.basepath = basepath
+        self.delay = delay
+        self.interval = interval
+        self.polling = polling or not INOTIFY
+        # set once the tree is watched
+        self.ready = threading.Event()
+        self._stopping = threading.Event()
+        self._changed = set()
+        self._resync = False
+        self._since = None
+        self._folders = {}
+
+    def stop(self):
+        self._stopping.set()
+
+    def changed(self, folder):
+        self._changed.add(folder)
+        if self._since is None:
+            self._since = time.time()
+
+    def overflowed(self):
+        self._resync = True
+        if self._since is None:
+            self._since = time.time()
+
+    def flush(self):
+        """
+        Apply the changes collected once they are ``delay`` seconds old.
+        """
+        if self._since is None or time.time() - self._since < self.delay:
+            return
+        folders, resync = sorted(self._changed), self._resync
+        self._changed, self._resync, self._since = set(), False, None
+        try:
+            apply_changes(self.basepath, folders, resync)
+        except Exception:
+            # the caches may be out of date, try again with the next change
+            self._resync = True
+
+    def _timeout(self, default):
+        if self._since is None:
+            return default
+        return max(0, self._since + self.delay - time.time())
+
+    def run(self):
+        if not self.polling:
+            try:
+                self._watch_inotify()
+            except (OSError, WatchLimitReached):
+                self.overflowed()
+                self.polling = True
+        if self.polling:
+            self._watch_polling()
+
+    def _watch_polling(self):
+        signatures = self.snapshot()
+        self.ready.set()
+        next_scan = time.time() + self.interval
+        while not self._stopping.wait(
+                min(self._timeout(self.interval), max(0, next_scan - time.time()))):
+            if time.time() >= next_scan:
+                new = self.snapshot()
+                for folder in set(signatures) | set(new):
+                    if signatures.get(folder) != new.get(folder):
+                        self.changed(folder)
+                signatures = new
+                next_scan = time.time() + self.interval
+            self.flush()
+
+    def snapshot(self):
+        """
+        A signature of the entries of each folder, scanning the whole tree.
+        """
+        signatures = {}
+        stack = ['/']
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = scan(self.basepath + folder)
+            except OSError:
+                continue
+            signatures[folder] = hash(tuple(sorted(entries)))
+            prefix = folder.rstrip('/') + '/'
+            stack.extend(
+                prefix + entry.name for entry in entries
+                if entry.is_dir and not entry.is_link
+            )
+        return signatures
+
+    def _watch_inotify(self):
+        fd = _libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        try:
+            self._add_tree(fd, '/')
+            self.ready.set()
+            while not self._stopping.is_set():
+                if select.select([fd], [], [], self._timeout(1))[0]:
+                    data = os.read(fd, 64*1024)
+                    offset = 0
+                    while offset < len(data):
+                        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                        offset += EVENT.size
+                        name = data[offset:offset + length].rstrip(b'\0')
+                        offset += length
+                        self._event(fd, wd, mask, _decode(name))
+                self.flush()
+        finally:
+            os.close(fd)
+
+    def _add_tree(self, fd, folder):
+        for dirpath, dirnames, filenames in os.walk(self.basepath + folder):
+            wd = _libc.inotify_add_watch(fd, _encode(dirpath), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise WatchLimitReached()
+                # removed in the meantime
+                continue
+            relpath = os.path.relpath(dirpath, self.basepath)
+            self._folders[wd] = '/' if relpath == '.' else '/' + relpath
+
+    def _event(self, fd, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed()
+            return
+        folder = self._folders.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self._folders[wd]
+            return
+        if is_temporary(name):
+            return
+        self.changed(folder)
+        if mask & IN_ISDIR:
+            path = folder.rstrip('/') + '/' + name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(fd, path)
+            elif mask & IN_MOVED_FROM:
+                # the watches of the moved folder are re-added if it is
+                # moved to another place of the tree
+                for wd, folder in list(self._folders.items()):
+                    if folder == path or folder.startswith(path + '/'):
+                        _libc.inotify_rm_watch(fd, wd)
+                        del self._folders[wd]
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def watch(basepath):
+    """
+    Start watching ``basepath`` unless it is already watched.
+    """
+    with _watchers_lock:
+        if basepath in _watchers:
+            return _watchers[basepath]
+        watcher = Watcher(
+            basepath,
+            settings.FILEMANAGER_WATCH_DELAY,
+            settings.FILEMANAGER_WATCH_INTERVAL,
+            settings.FILEMANAGER_WATCH == 'poll',
+        )
+        watcher.start()
+        _watchers[basepath] = watcher
+        return watcher
+
+
+def unwatch(basepath):
+    with _watchers_lock:
+        watcher = _watchers.pop(basepath, None)
+    if watcher is not None:
+        watcher.stop()
@@ -8,6 +8,8 @@ def filemanager_config(url):
     d = {}
     d['filebrowserBrowseUrl'] = url
     d['filebrowserImageBrowseUrl'] = url
+    d['filebrowserUploadUrl'] = url + '?quickupload'
+    d['filebrowserImageUploadUrl'] = url + '?quickupload'
     d['filebrowserWidth'] = 800
     d['filebrowserHeight'] = 500
     return d
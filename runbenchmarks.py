@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, "tests")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+if __name__ == "__main__":
+    import django
+    django.setup()
+    from benchmarks import SIZES, compare, load, run_benchmarks
+
+    parser = argparse.ArgumentParser(description='Benchmark the filemanager on a generated tree.')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--shape', choices=['wide', 'deep'], default='wide')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='save the results as JSON in this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.size, args.shape, args.repeat, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(load(args.compare), results)
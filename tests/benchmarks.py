@@ -0,0 +1,304 @@
+"""
+Benchmarks of the FileManager hot paths on generated trees, run with
+runbenchmarks.py.
+"""
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import zipfile
+
+import django
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+
+from filemanager import FileManager, FileManagerForm
+from filemanager import settings as fm_settings
+from filemanager.listing import listing_cache
+
+SIZES = {
+    'small': 1000,
+    'medium': 50000,
+    'large': 500000,
+}
+
+# files per folder of a wide tree and folders per chain of a deep one
+WIDE_FOLDER_FILES = 1000
+DEEP_LEVELS = 20
+
+UPLOAD_FILES = 20
+UPLOAD_FILE_SIZE = 256*1024
+ZIP_FILES = 500
+COPY_FILES = 1000
+
+
+def make_tree(root, files, shape):
+    """
+    Create ``files`` small files under ``root``: a 'wide' tree has one
+    level of folders of WIDE_FOLDER_FILES files, a 'deep' tree has chains
+    of DEEP_LEVELS nested folders with a few files at every level.
+    """
+    folders = []
+    if shape == 'wide':
+        for i in range(max(1, files // WIDE_FOLDER_FILES)):
+            folders.append(os.path.join(root, 'folder%d' % i))
+    else:
+        chains = max(1, files // (DEEP_LEVELS * 50))
+        for i in range(chains):
+            path = os.path.join(root, 'chain%d' % i)
+            for level in range(DEEP_LEVELS):
+                path = os.path.join(path, 'level%d' % level)
+                folders.append(path)
+    for folder in folders:
+        os.makedirs(folder)
+    for i in range(files):
+        folder = folders[i % len(folders)]
+        with open(os.path.join(folder, 'file%d.txt' % i), 'wb') as f:
+            f.write(b'x' * (i % 4096))
+    age_folders(root)
+
+
+def age_folders(root):
+    """
+    Set the mtime of the folders under ``root`` in the past so that their
+    listings are cacheable right away.
+    """
+    past = time.time() - 60
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.utime(dirpath, (past, past))
+
+
+def png(width=1600, height=1200):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (90, 120, 150)).save(output, 'png')
+    return output.getvalue()
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def consume(response):
+    if response.streaming:
+        for chunk in response.streaming_content:
+            pass
+    else:
+        response.content
+
+
+def submit(fm, files=None, **data):
+    data.setdefault('path', '/')
+    data.setdefault('current_path', '/')
+    data.setdefault('file_or_dir', 'dir')
+    form = FileManagerForm(data)
+    assert form.is_valid(), form.errors
+    return fm.handle_form(form, files)
+
+
+class Benchmarks(object):
+    """
+    Each ``bench_<name>`` method returns a function running the measured
+    operation once; ``<name>_cleanup`` undoes what it changed, outside of
+    the measured time.
+    """
+
+    def __init__(self, root, size, shape):
+        self.root = root
+        self.basepath = os.path.join(root, 'basepath')
+        self.data = os.path.join(root, 'data')
+        os.makedirs(self.data)
+        make_tree(os.path.join(self.basepath, 'tree'), SIZES[size], shape)
+        write(os.path.join(self.basepath, 'image.png'), png())
+        write(os.path.join(self.basepath, 'big.bin'), os.urandom(32*1024*1024))
+        make_tree(os.path.join(self.basepath, 'copy'), COPY_FILES, 'wide')
+        with zipfile.ZipFile(os.path.join(self.data, 'archive.zip'), 'w') as zf:
+            for i in range(ZIP_FILES):
+                zf.writestr('archive/file%d.txt' % i, b'x' * (i % 4096))
+        age_folders(self.basepath)
+        self.fm = FileManager(
+            self.basepath,
+            maxfolders=10**9,
+            maxspace=10**9,
+            maxfilesize=10**9,
+        )
+        self.fm.current_path = '/'
+        self.factory = RequestFactory()
+        self.runs = 0
+
+    def bench_render(self):
+        request = self.factory.get('/')
+        return lambda: self.fm.render(request, '').content
+
+    def bench_directory_structure(self):
+        return self.fm.directory_structure
+
+    def bench_directory_structure_cold(self):
+        def run():
+            listing_cache.invalidate()
+            self.fm.directory_structure()
+        return run
+
+    def bench_get_size(self):
+        return lambda: self.fm.get_size(self.basepath)
+
+    def bench_media_thumbnail(self):
+        return lambda: self.fm.media('image.png', self.factory.get('/')).content
+
+    def bench_media_thumbnail_cold(self):
+        path = os.path.join(self.basepath, 'image.png')
+
+        def run():
+            # a new mtime makes a new thumbnail cache key
+            self.runs += 1
+            os.utime(path, (time.time(), time.time() + self.runs))
+            self.fm.media('image.png', self.factory.get('/')).content
+        return run
+
+    def bench_download_file(self):
+        request = self.factory.get('/')
+        return lambda: consume(self.fm.download('big.bin', 'file', request))
+
+    def bench_download_dir(self):
+        request = self.factory.get('/', {'format': 'tar.gz'})
+        return lambda: consume(self.fm.download('copy/', 'dir', request))
+
+    def bench_upload(self):
+        data = os.urandom(UPLOAD_FILE_SIZE)
+
+        def run():
+            files = MultiValueDict({'ufile': [
+                SimpleUploadedFile('upload%d.bin' % i, data)
+                for i in range(UPLOAD_FILES)
+            ]})
+            submit(self.fm, files, action='upload', path='/upload/', file_or_dir='file')
+        os.mkdir(os.path.join(self.basepath, 'upload'))
+        return run
+
+    def upload_cleanup(self):
+        self.reset(os.path.join(self.basepath, 'upload'))
+
+    def bench_unzip(self):
+        target = os.path.join(self.basepath, 'unzip')
+        os.mkdir(target)
+        shutil.copy(os.path.join(self.data, 'archive.zip'), target)
+        return lambda: submit(
+            self.fm,
+            action='unzip',
+            path='/unzip/archive.zip',
+            current_path='/unzip/',
+            file_or_dir='file',
+        )
+
+    def unzip_cleanup(self):
+        shutil.rmtree(os.path.join(self.basepath, 'unzip', 'archive'))
+
+    def bench_copy(self):
+        os.mkdir(os.path.join(self.basepath, 'copies'))
+        return lambda: submit(
+            self.fm,
+            action='copy',
+            path='/copy/',
+            current_path='/copies/',
+        )
+
+    def copy_cleanup(self):
+        self.reset(os.path.join(self.basepath, 'copies'))
+
+    def reset(self, folder):
+        shutil.rmtree(folder)
+        os.mkdir(folder)
+
+    def names(self):
+        return sorted(
+            name[len('bench_'):] for name in dir(self)
+            if name.startswith('bench_')
+        )
+
+    def run(self, name, repeat):
+        run = getattr(self, 'bench_' + name)()
+        cleanup = getattr(self, name + '_cleanup', None)
+        timings = []
+        for i in range(repeat):
+            start = timeit.default_timer()
+            run()
+            timings.append(timeit.default_timer() - start)
+            if cleanup:
+                cleanup()
+        timings.sort()
+        return {
+            'runs': repeat,
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(size='small', shape='wide', repeat=5, only=None, stream=sys.stdout):
+    # measure the operations themselves, not the background job queue
+    fm_settings.FILEMANAGER_JOB_THRESHOLD = None
+    root = tempfile.mkdtemp()
+    try:
+        stream.write('Generating a %s %s tree...\n' % (size, shape))
+        benchmarks = Benchmarks(root, size, shape)
+        results = {}
+        for name in benchmarks.names():
+            if only and name not in only:
+                continue
+            results[name] = benchmarks.run(name, repeat)
+            stream.write('%-28s %10.2f ms\n' % (name, results[name]['median'] * 1000))
+    finally:
+        shutil.rmtree(root)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'size': size,
+        'files': SIZES[size],
+        'shape': shape,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(old, new, stream=sys.stdout):
+    """
+    Print the median of every benchmark of ``new`` next to ``old``.
+    """
+    for name in sorted(new['results']):
+        median = new['results'][name]['median']
+        if name in old['results']:
+            before = old['results'][name]['median']
+            change = '%+.1f%%' % ((median - before) * 100 / before) if before else ''
+            stream.write(
+                '%-28s %10.2f ms %10.2f ms %8s\n'
+                % (name, before * 1000, median * 1000, change)
+            )
+        else:
+            stream.write('%-28s %10s    %10.2f ms\n' % (name, '-', median * 1000))
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -1,5 +1,45 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import signal
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import zipfile
+from concurrent.futures import Future
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
-from django.test import Client, TestCase
+from django.test import Client, RequestFactory, TestCase
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+
+from filemanager import FileManager, FileManagerForm, ledger
+from filemanager import settings as fm_settings
+from filemanager import thumbnails
+from filemanager.archives import ZIP_STREAMING
+from filemanager.csrf import quick_upload_csrf
+from filemanager.jobs import job_queue
+from filemanager.listing import ListingCache
+from filemanager.metrics import metric_recorded, prometheus_view
+from filemanager.mime import MimeDetector, allowed_types
+from filemanager.resumable import UploadSession
+from filemanager.state import StateRegistry
+from filemanager.thumbnails import (FORMAT_COOKIE, ThumbnailPool, get_icon,
+                                    thumbnail_cache)
+from filemanager.tree import encode_tree
+from filemanager.watcher import INOTIFY, Watcher, apply_changes
+
+if sys.version_info >= (3, 6):
+    import asyncio
+
+    from filemanager.aio import AsyncFileManager
 
 
 class FilemanagerTest(TestCase):
@@ -11,3 +51,991 @@ class FilemanagerTest(TestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, 200)
+
+
+class FileManagerTestCase(TestCase):
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basepath)
+        self.fm = FileManager(self.basepath)
+
+    def write(self, relpath, content=b'x'):
+        filepath = os.path.join(self.basepath, relpath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        return filepath
+
+    def submit(self, files=None, **data):
+        data.setdefault('path', '/')
+        data.setdefault('current_path', '/')
+        data.setdefault('file_or_dir', 'dir')
+        form = FileManagerForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        return self.fm.handle_form(form, files)
+
+
+class UsageLedgerTest(FileManagerTestCase):
+    def test_ledger_is_built_from_disk(self):
+        self.write('a/b.txt', b'12345')
+        self.write('c.txt', b'123')
+
+        self.assertEqual(self.fm.usage.get(), {'bytes': 8, 'folders': 2})
+
+    def test_actions_update_ledger(self):
+        self.write('a/b.txt', b'12345')
+        self.fm.usage.get()
+
+        self.submit(action='add', name='new')
+        self.submit(action='copy', path='/a/', current_path='/new/')
+        self.assertEqual(self.fm.usage.get(), {'bytes': 10, 'folders': 4})
+
+        self.submit(action='delete', path='/a/')
+        self.submit(action='delete', path='/new/a/b.txt', file_or_dir='file')
+        self.assertEqual(self.fm.usage.get(), {'bytes': 0, 'folders': 3})
+
+
+class SearchTest(FileManagerTestCase):
+    def search(self, query, **params):
+        params['search'] = query
+        response = self.fm.search(RequestFactory().get('/', params))
+        return json.loads(response.content.decode())
+
+    def paths(self, query, **params):
+        return [r['path'] for r in self.search(query, **params)['results']]
+
+    def test_prefix_substring_and_extension(self):
+        self.write('docs/Report-2017.pdf')
+        self.write('docs/notes.txt')
+        self.write('old_report.pdf')
+
+        self.assertEqual(self.paths('rep', mode='prefix'), ['/docs/Report-2017.pdf'])
+        self.assertEqual(self.paths('report'), ['/old_report.pdf', '/docs/Report-2017.pdf'])
+        self.assertEqual(self.paths('', ext='pdf'), ['/old_report.pdf', '/docs/Report-2017.pdf'])
+        self.assertEqual(self.paths('o', ext='txt'), ['/docs/notes.txt'])
+
+    def test_results_are_paginated(self):
+        for i in range(5):
+            self.write('f%d.txt' % i)
+
+        page = self.search('.txt', limit=2)
+        self.assertEqual([r['name'] for r in page['results']], ['f0.txt', 'f1.txt'])
+        page = self.search('.txt', limit=2, after=page['next'])
+        self.assertEqual([r['name'] for r in page['results']], ['f2.txt', 'f3.txt'])
+        page = self.search('.txt', limit=2, after=page['next'])
+        self.assertEqual([r['name'] for r in page['results']], ['f4.txt'])
+        self.assertIsNone(page['next'])
+
+    def test_index_follows_actions(self):
+        self.write('a/b.txt')
+        self.assertEqual(self.paths('b.txt'), ['/a/b.txt'])
+
+        self.submit(action='rename', path='/a/', name='c')
+        self.assertEqual(self.paths('b.txt'), ['/c/b.txt'])
+        self.submit(action='add', path='/', name='d')
+        self.submit(action='copy', path='/c/', current_path='/d/')
+        self.assertEqual(self.paths('b.txt'), ['/c/b.txt', '/d/c/b.txt'])
+        self.submit(action='delete', path='/c/')
+        self.assertEqual(self.paths('b.txt'), ['/d/c/b.txt'])
+        self.assertEqual(self.paths('', mode='prefix'), ['/d/c/b.txt', '/d/c', '/d'])
+
+    def test_concurrent_rebuilds(self):
+        for i in range(200):
+            self.write('d%d/f%d.txt' % (i % 10, i))
+        errors = []
+
+        def rebuild():
+            try:
+                self.fm.search_index.rebuild()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=rebuild) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.paths('f1', mode='prefix', limit=1000)), 111)
+
+
+class ActionApiTest(FileManagerTestCase):
+    def action(self, **data):
+        data.setdefault('path', '/')
+        data.setdefault('current_path', '/')
+        data.setdefault('file_or_dir', 'dir')
+        response = self.fm.render(RequestFactory().post('/?action', data), '')
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_rename_returns_the_changed_folder(self):
+        self.write('a/b.txt')
+        self.write('c.txt')
+
+        data = self.action(action='rename', path='/a/b.txt', name='d.txt', file_or_dir='file')
+
+        self.assertEqual(data['messages'], ['File renamed successfully from b.txt to d.txt'])
+        self.assertEqual(
+            data['delta'],
+            [{'path': '/a/', 'dirs': [], 'files': ['d.txt'], 'deep': False}],
+        )
+
+    def test_move_returns_both_folders(self):
+        self.write('a/b/c.txt')
+        os.mkdir(os.path.join(self.basepath, 'd'))
+
+        data = self.action(action='move', path='/a/b/', current_path='/d/')
+
+        self.assertEqual([n['path'] for n in data['delta']], ['/a/', '/d/'])
+        self.assertEqual([n['dirs'] for n in data['delta']], [[], ['b']])
+
+    def test_quick_upload(self):
+        self.fm.ckeditor_baseurl = '/media'
+        request = RequestFactory().post(
+            '/?quickupload&CKEditorFuncNum=3&responseType=json',
+            {'upload': SimpleUploadedFile('a b.txt', b'text')},
+        )
+
+        data = json.loads(self.fm.render(request, '').content.decode('utf-8'))
+
+        self.assertEqual(data, {'uploaded': 1, 'fileName': 'a_b.txt', 'url': '/media/a_b.txt'})
+        self.assertEqual(self.fm.usage.bytes, 4)
+
+        request = RequestFactory().post(
+            '/?quickupload&CKEditorFuncNum=3',
+            {'upload': SimpleUploadedFile('a<b.txt', b'text')},
+        )
+        content = self.fm.render(request, '').content.decode('utf-8')
+        self.assertIn('callFunction("3", "", "File name is not valid : a\\u003cb.txt")', content)
+
+    def test_only_quick_upload_uses_the_ckeditor_token(self):
+        view = quick_upload_csrf(lambda request, path: self.fm.render(request, path))
+        factory = RequestFactory()
+
+        def upload(token):
+            request = factory.post(
+                '/?quickupload&responseType=json',
+                {'upload': SimpleUploadedFile('a.txt', b'text'), 'ckCsrfToken': token},
+            )
+            request.COOKIES['ckCsrfToken'] = 'abc'
+            return view(request, '')
+
+        self.assertEqual(upload('xyz').status_code, 403)
+        self.assertEqual(json.loads(upload('abc').content.decode('utf-8'))['uploaded'], 1)
+
+        request = factory.post('/', {'action': 'delete', 'path': '/a.txt', 'file_or_dir': 'file'})
+        request.COOKIES['ckCsrfToken'] = 'abc'
+        self.assertEqual(view(request, '').status_code, 403)
+        self.assertTrue(os.path.exists(os.path.join(self.basepath, 'a.txt')))
+
+
+class LazyTreeTest(FileManagerTestCase):
+    def test_only_path_to_current_folder_is_listed(self):
+        self.write('a/b/c/d.txt')
+        self.write('e/f/g.txt')
+        self.fm.current_path = '/a/b/'
+
+        tree = self.fm.lazy_directory_structure()
+
+        root = tree['']
+        self.assertEqual(sorted(root['dirs']), ['a', 'e'])
+        self.assertEqual(root['dirs']['e']['loaded'], 'no')
+        self.assertEqual(root['dirs']['e']['dirs'], {})
+        b = root['dirs']['a']['dirs']['b']
+        self.assertEqual(b['open'], 'yes')
+        self.assertEqual(self.fm.current_id, b['id'])
+        self.assertEqual(b['dirs']['c']['loaded'], 'no')
+
+    def test_tree_returns_one_level(self):
+        self.write('e/f/g.txt')
+        self.write('e/h.txt')
+
+        response = self.fm.tree('e/')
+
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8')),
+            {'dirs': ['f'], 'files': ['h.txt']},
+        )
+        self.assertEqual(self.fm.tree('../').status_code, 400)
+
+
+class ListingCacheTest(FileManagerTestCase):
+    def test_unchanged_directory_is_reused(self):
+        self.write('a/b.txt', b'123')
+        old = time.time() - 60
+        os.utime(os.path.join(self.basepath, 'a'), (old, old))
+        cache = ListingCache(100)
+
+        listing = cache.get(os.path.join(self.basepath, 'a'))
+        self.assertIs(cache.get(os.path.join(self.basepath, 'a')), listing)
+        self.assertEqual(listing.entries[0].size, 3)
+
+        self.write('a/c.txt')
+        os.utime(os.path.join(self.basepath, 'a'), (old + 1, old + 1))
+        self.assertEqual(
+            sorted(cache.get(os.path.join(self.basepath, 'a')).files),
+            ['b.txt', 'c.txt'],
+        )
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class StateRegistryTest(FileManagerTestCase):
+    def test_instances_share_the_state_of_their_configuration(self):
+        other = FileManager(self.basepath + '/', maxspace=1)
+        self.assertIs(other.usage, self.fm.usage)
+        self.assertIs(other.search_index, self.fm.search_index)
+        restricted = FileManager(self.basepath, extensions=['txt'])
+        self.assertIsNot(restricted.state, self.fm.state)
+        self.assertIs(restricted.state.allowed_types, allowed_types(['txt']))
+
+    def test_stale_states_are_evicted(self):
+        registry = StateRegistry(2, 60)
+        first = registry.get('/a')
+        registry.get('/b')
+        self.assertIs(registry.get('/a'), first)
+        registry.get('/c')
+        self.assertEqual(
+            sorted(key[0] for key in registry._states),
+            ['/a', '/c'],
+        )
+        first.last_used -= 120
+        registry.get('/d')
+        self.assertEqual(
+            sorted(key[0] for key in registry._states),
+            ['/c', '/d'],
+        )
+
+
+class WatcherTest(FileManagerTestCase):
+    def test_outside_changes_reach_the_caches(self):
+        self.fm.search_index.rebuild()
+        self.assertEqual(self.fm.usage.bytes, 0)
+        self.write('sub/deeper/new.txt', b'1234')
+        apply_changes(self.basepath, ['/'])
+        results, _ = self.fm.search_index.search('new')
+        self.assertEqual([r['path'] for r in results], ['/sub/deeper/new.txt'])
+        self.assertEqual(self.fm.usage.bytes, 4)
+
+        shutil.rmtree(os.path.join(self.basepath, 'sub'))
+        apply_changes(self.basepath, ['/'])
+        self.assertEqual(self.fm.search_index.search('new')[0], [])
+        self.assertEqual(self.fm.usage.bytes, 0)
+
+    def test_changes_are_counted_once_without_walking_the_tree(self):
+        self.write('a.txt', b'12')
+        self.fm.search_index.rebuild()
+        self.fm.usage.rebuild()
+        self.addCleanup(setattr, ledger, 'measure', ledger.measure)
+        ledger.measure = None
+
+        self.write('sub/b.txt', b'1234')
+        with open(os.path.join(self.basepath, 'a.txt'), 'ab') as f:
+            f.write(b'345')
+        # the watchers of two processes see the same change
+        apply_changes(self.basepath, ['/'])
+        apply_changes(self.basepath, ['/'])
+        self.assertEqual((self.fm.usage.bytes, self.fm.usage.folders), (9, 2))
+
+        self.submit(action='delete', path='/sub/')
+        apply_changes(self.basepath, ['/'])
+        self.assertEqual((self.fm.usage.bytes, self.fm.usage.folders), (5, 1))
+
+        # a change the watcher applies before the action counts it
+        self.write('c.txt', b'123')
+        apply_changes(self.basepath, ['/'])
+        self.fm.update_usage(self.fm.search_index.add('/c.txt'), bytes=3)
+        self.assertEqual((self.fm.usage.bytes, self.fm.usage.folders), (8, 1))
+
+    def watch(self, polling):
+        self.write('sub/old.txt', b'1')
+        self.fm.usage.rebuild()
+        watcher = Watcher(self.basepath, delay=0.05, interval=0.05, polling=polling)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        self.assertTrue(watcher.ready.wait(5))
+        self.write('sub/new.txt', b'123')
+        deadline = time.time() + 5
+        while self.fm.usage.bytes != 4 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.fm.usage.bytes, 4)
+
+    def test_polling_watcher(self):
+        self.watch(polling=True)
+
+    def test_inotify_watcher(self):
+        if not INOTIFY:
+            self.skipTest('inotify is not available')
+        self.watch(polling=False)
+
+
+class MimeTest(FileManagerTestCase):
+    def test_listing_has_the_detected_types(self):
+        output = io.BytesIO()
+        Image.new('RGB', (1, 1)).save(output, 'png')
+        self.write('image.dat', output.getvalue())
+        self.write('notes.png', b'plain text, not an image\n')
+        response = self.fm.list_page('/', RequestFactory().get('/', {'list': ''}))
+        entries = json.loads(response.content.decode('utf-8'))['entries']
+        self.assertEqual(
+            dict((e['name'], e['mimetype']) for e in entries),
+            {'image.dat': 'image/png', 'notes.png': 'text/plain'},
+        )
+
+    def test_detection_is_cached_until_the_file_changes(self):
+        detector = MimeDetector(10)
+        path = self.write('a', b'plain text\n')
+        self.assertEqual(detector.detect(path), 'text/plain')
+        self.assertEqual(detector.detect(path), 'text/plain')
+        self.assertEqual((detector.hits, detector.misses), (1, 1))
+        output = io.BytesIO()
+        Image.new('RGB', (1, 1)).save(output, 'png')
+        self.write('a', output.getvalue())
+        self.assertEqual(detector.detect(path), 'image/png')
+
+
+class PageTest(FileManagerTestCase):
+    def test_tree_is_sent_in_columns(self):
+        self.write('a/x.txt')
+        self.write('b/x.txt')
+        self.fm.current_path = '/'
+        tree = encode_tree(self.fm.directory_structure())
+        names = tree['names']
+        self.assertEqual(sorted(names), ['', 'a', 'b', 'x.txt'])
+        self.assertEqual(tree['parent'], [-1, 0, 0])
+        self.assertEqual(tree['flags'], [1, 0, 0])
+        self.assertEqual(
+            dict(
+                (names[name], [names[f] for f in files])
+                for name, files in zip(tree['name'], tree['files'])
+            ),
+            {'': [], 'a': ['x.txt'], 'b': ['x.txt']},
+        )
+
+    def test_unchanged_page_is_not_sent_again(self):
+        page_etag = fm_settings.FILEMANAGER_PAGE_ETAG
+        self.addCleanup(setattr, fm_settings, 'FILEMANAGER_PAGE_ETAG', page_etag)
+        fm_settings.FILEMANAGER_PAGE_ETAG = True
+        self.write('a.txt')
+        factory = RequestFactory()
+
+        response = self.fm.render(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'), '')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'a.txt', gzip.GzipFile(fileobj=io.BytesIO(response.content)).read())
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        response = self.fm.render(factory.get('/', HTTP_IF_NONE_MATCH=etag), '')
+        self.assertEqual(response.status_code, 304)
+        self.submit(action='add', name='b')
+        response = self.fm.render(factory.get('/', HTTP_IF_NONE_MATCH=etag), '')
+        self.assertEqual(response.status_code, 200)
+
+
+class ListPageTest(FileManagerTestCase):
+    def list_page(self, **params):
+        params['list'] = ''
+        response = self.fm.list_page('/', RequestFactory().get('/', params))
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_pages_follow_the_sort_order(self):
+        self.write('sub/x.txt')
+        self.write('b.png', b'123')
+        self.write('A.txt', b'12')
+        self.write('c.txt', b'1')
+
+        page = self.list_page(sort='size', limit=2)
+        self.assertEqual([e['name'] for e in page['entries']], ['sub', 'c.txt'])
+        self.assertIsNone(page['entries'][0]['mimetype'])
+        # entries added in the meantime do not shift the next page
+        self.write('0.txt')
+        page = self.list_page(sort='size', limit=2, after=page['next'])
+        self.assertEqual([e['name'] for e in page['entries']], ['A.txt', 'b.png'])
+        self.assertIsNone(page['next'])
+
+        page = self.list_page(ext='txt', desc='')
+        self.assertEqual([e['name'] for e in page['entries']], ['c.txt', 'A.txt', '0.txt'])
+
+    def test_files_rewritten_in_place_are_stated_again(self):
+        path = self.write('a.txt', b'1')
+        old = time.time() - 60
+        os.utime(self.basepath, (old, old))
+        self.assertEqual(self.list_page()['entries'][0]['size'], 1)
+
+        with open(path, 'ab') as f:
+            f.write(b'2' * 5000)
+        os.utime(self.basepath, (old, old))
+
+        entry = self.list_page()['entries'][0]
+        self.assertEqual(entry['size'], 5001)
+        self.assertEqual(entry['mtime'], os.path.getmtime(path))
+
+    def test_large_folders_are_paged(self):
+        page_size = fm_settings.FILEMANAGER_LIST_PAGE_SIZE
+        self.addCleanup(setattr, fm_settings, 'FILEMANAGER_LIST_PAGE_SIZE', page_size)
+        fm_settings.FILEMANAGER_LIST_PAGE_SIZE = 2
+        for name in ('a/1', 'a/2', 'a/3', 'b/1'):
+            self.write(name)
+        self.fm.current_path = '/'
+
+        tree = self.fm.directory_structure()['']['dirs']
+
+        self.assertEqual((tree['a']['files'], tree['a']['paged']), ([], 'yes'))
+        self.assertEqual(tree['b']['files'], ['1'])
+        self.assertNotIn('paged', tree['b'])
+
+
+class MediaTest(FileManagerTestCase):
+    def test_thumbnail_is_cached_and_validated(self):
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, 'png')
+        self.write('a.png', output.getvalue())
+        request = RequestFactory().get('/')
+
+        response = self.fm.media('a.png', request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(response.content)).size, (60, 30))
+
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(self.fm.media('a.png', request).status_code, 304)
+        request = RequestFactory().get(
+            '/',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+        )
+        self.assertEqual(self.fm.media('a.png', request).status_code, 304)
+
+    def test_icon_is_served_for_other_files(self):
+        self.write('a.pdf', b'%PDF-1.4')
+        self.write('b.unknown')
+
+        response = self.fm.media('a.pdf')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response.content, get_icon('pdf').data)
+        self.assertEqual(self.fm.media('b.unknown')['ETag'], get_icon('default').etag)
+
+    def test_thumbnails_are_made_once(self):
+        output = io.BytesIO()
+        Image.new('RGB', (1600, 800)).save(output, 'jpeg')
+        path = self.write('a.jpg', output.getvalue())
+        pool = ThumbnailPool(1, processes=False)
+        submitted = []
+        submit = pool._submit
+
+        def counting_submit(*args):
+            submitted.append(args[0])
+            return submit(*args)
+        pool._submit = counting_submit
+        key = uuid.uuid4().hex
+
+        pool.prefetch(key, path, 'jpeg')
+        data = pool.get(key, path, 'jpeg')
+        self.assertEqual(pool.get(key, path, 'jpeg'), data)
+        self.assertEqual(submitted, [key])
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (60, 30))
+
+    def test_listings_prefetch_the_format_the_page_asks_for(self):
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, 'png')
+        path = self.write('a.png', output.getvalue())
+        st = os.stat(path)
+        factory = RequestFactory()
+        for format in ('webp', 'original'):
+            thumbnail = factory.get('/a.png', {'format': format}, HTTP_ACCEPT='image/webp,*/*')
+            key = self.fm.thumbnail_key(
+                path, st.st_mtime, st.st_size, self.fm.thumbnail_variant('image/png', 'png', thumbnail),
+            ).strip('"')
+            listing = factory.get('/', {'list': ''}, HTTP_ACCEPT='application/json, */*')
+            listing.COOKIES[FORMAT_COOKIE] = format
+
+            self.fm.list_page('/', listing)
+
+            deadline = time.time() + 5
+            while not thumbnail_cache.has(key) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(thumbnail_cache.has(key), format)
+            response = self.fm.media('a.png', thumbnail)
+            self.assertEqual(response['ETag'].strip('"'), key)
+            self.assertEqual(response['Content-Type'], 'image/webp' if format == 'webp' else 'image/png')
+
+    def test_thumbnail_pool_survives_a_dead_worker(self):
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, 'png')
+        path = self.write('a.png', output.getvalue())
+        pool = ThumbnailPool(1)
+        self.addCleanup(lambda: pool._executor.shutdown())
+        pool.get(uuid.uuid4().hex, path, 'png')
+        executor = pool._executor
+
+        for process in list(executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        deadline = time.time() + 5
+        while not executor._broken and time.time() < deadline:
+            time.sleep(0.05)
+
+        pool.prefetch(uuid.uuid4().hex, path, 'png')
+        data = pool.get(uuid.uuid4().hex, path, 'png')
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (60, 30))
+        self.assertIsNot(pool._executor, executor)
+
+    def test_slow_thumbnails_fall_back_to_the_icon(self):
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, 'png')
+        self.write('a.png', output.getvalue())
+        pool = ThumbnailPool(1, processes=False, timeout=0.01)
+        # a job that never finishes
+        pool._submit = lambda *args: Future()
+        self.addCleanup(setattr, thumbnails, '_thumbnail_pool', thumbnails._thumbnail_pool)
+        thumbnails._thumbnail_pool = pool
+
+        response = self.fm.media('a.png', RequestFactory().get('/'))
+
+        self.assertEqual(response.content, get_icon('png').data)
+
+    def test_thumbnail_variants(self):
+        output = io.BytesIO()
+        Image.new('RGBA', (1000, 500)).save(output, 'png')
+        self.write('a.png', output.getvalue())
+
+        response = self.fm.media('a.png', RequestFactory().get(
+            '/', {'size': 'medium'}, HTTP_ACCEPT='image/webp,*/*',
+        ))
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        image = Image.open(io.BytesIO(response.content))
+        self.assertEqual((image.format, image.size), ('WEBP', (200, 100)))
+
+        png = self.fm.media('a.png', RequestFactory().get('/', {'size': 'medium'}))
+        self.assertEqual(png['Content-Type'], 'image/png')
+        self.assertNotEqual(png['ETag'], response['ETag'])
+
+        jpeg = self.fm.media('a.png', RequestFactory().get('/', {'format': 'jpeg'}))
+        image = Image.open(io.BytesIO(jpeg.content))
+        self.assertEqual((image.format, image.size), ('JPEG', (60, 30)))
+
+        for query in ({'size': 'huge'}, {'format': 'bmp'}):
+            response = self.fm.media('a.png', RequestFactory().get('/', query))
+            self.assertEqual(response.status_code, 400)
+
+
+class DownloadTest(FileManagerTestCase):
+    def download(self, **headers):
+        request = RequestFactory().get('/', **headers)
+        response = self.fm.download('a.txt', 'file', request)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return response, content
+
+    def test_file_is_streamed_with_ranges(self):
+        self.write('a.txt', b'0123456789')
+
+        response, content = self.download()
+        self.assertEqual((response.status_code, content), (200, b'0123456789'))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response, content = self.download(HTTP_RANGE='bytes=2-4')
+        self.assertEqual((response.status_code, content), (206, b'234'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response, content = self.download(HTTP_RANGE='bytes=0-1,-2')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertIn(b'Content-Range: bytes 8-9/10\r\n\r\n89', content)
+
+        response, content = self.download(HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+
+        response, content = self.download(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_parent_folders_are_not_downloaded(self):
+        self.write('a.txt', b'secret')
+        fm = FileManager(os.path.join(self.basepath, 'sub'))
+
+        response = fm.download('../a.txt', 'file', RequestFactory().get('/'))
+
+        self.assertEqual(response.content, b'Invalid path')
+
+    def test_x_accel_redirect_with_the_default_root(self):
+        backend = fm_settings.FILEMANAGER_SENDFILE
+        self.addCleanup(setattr, fm_settings, 'FILEMANAGER_SENDFILE', backend)
+        fm_settings.FILEMANAGER_SENDFILE = 'x-accel-redirect'
+        path = self.write('a.txt', b'0123456789')
+
+        response, content = self.download()
+
+        self.assertEqual(content, b'')
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            '/protected' + os.path.abspath(path),
+        )
+
+    def archive(self, **params):
+        request = RequestFactory().get('/', params)
+        response = self.fm.download('', params.pop('download', 'dir'), request)
+        return io.BytesIO(b''.join(response.streaming_content))
+
+    def test_directory_archives_are_streamed(self):
+        self.write('a/b.txt', b'b' * 100000)
+        self.write('a/c/d.jpg', b'd')
+        self.write('e.txt', b'e')
+        names = ['a', 'a/b.txt', 'a/c', 'a/c/d.jpg', 'e.txt']
+
+        archive = self.archive(download='archive', path=['a/', 'e.txt'])
+        with tarfile.open(fileobj=archive, mode='r:gz') as tar:
+            self.assertEqual(sorted(tar.getnames()), names)
+            self.assertEqual(tar.extractfile('a/b.txt').read(), b'b' * 100000)
+
+        archive = self.archive(download='archive', path=['a/', 'e.txt'], format='tar')
+        with tarfile.open(fileobj=archive, mode='r:') as tar:
+            self.assertEqual(sorted(tar.getnames()), names)
+
+        if ZIP_STREAMING:
+            archive = self.archive(download='archive', path=['a/', 'e.txt'], format='zip')
+            with zipfile.ZipFile(archive) as zf:
+                self.assertEqual(zf.read('a/b.txt'), b'b' * 100000)
+                self.assertEqual(zf.getinfo('a/c/d.jpg').compress_type, zipfile.ZIP_STORED)
+
+
+@unittest.skipUnless(sys.version_info >= (3, 6), 'needs Python 3.6+')
+class AsyncFileManagerTest(FileManagerTestCase):
+    def setUp(self):
+        super(AsyncFileManagerTest, self).setUp()
+        self.afm = AsyncFileManager(self.basepath)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def render(self, path, **params):
+        return self.loop.run_until_complete(
+            self.afm.render(RequestFactory().get('/', params), path)
+        )
+
+    def test_views(self):
+        self.write('a.txt', b'0123456789')
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, 'png')
+        self.write('b.png', output.getvalue())
+
+        self.assertContains(self.render(''), 'a.txt')
+        response = self.render('b.png')
+        self.assertEqual(Image.open(io.BytesIO(response.content)).size, (60, 30))
+
+        response = self.render('a.txt', download='file')
+        if getattr(response, 'is_async', False):
+            chunks = response.streaming_content
+            content = b''
+            while True:
+                try:
+                    content += self.loop.run_until_complete(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+        else:
+            content = b''.join(response.streaming_content)
+        self.assertEqual(content, b'0123456789')
+
+
+class ConcurrencyTest(TestCase):
+    def test_mixed_actions_from_many_threads(self):
+        basepaths = [tempfile.mkdtemp() for i in range(3)]
+        for basepath in basepaths:
+            self.addCleanup(shutil.rmtree, basepath)
+        errors = []
+
+        def submit(fm, **data):
+            data.setdefault('path', '/')
+            data.setdefault('current_path', '/')
+            data.setdefault('file_or_dir', 'dir')
+            form = FileManagerForm(data)
+            form.is_valid()
+            return fm.handle_form(form, None)
+
+        def worker(n):
+            try:
+                basepath = basepaths[n % len(basepaths)]
+                for i in range(10):
+                    fm = FileManager(basepath, maxfolders=1000)
+                    name = 't%d_%d' % (n, i)
+                    submit(fm, action='add', name=name)
+                    submit(fm, action='add', path='/%s/' % name, name='sub')
+                    submit(fm, action='rename', path='/%s/' % name, name=name + 'r')
+                    submit(fm, action='add', name=name + 'c')
+                    submit(fm, action='copy', path='/%sr/sub/' % name, current_path='/%sc/' % name)
+                    fm.current_path = '/'
+                    fm.directory_structure()
+                    if i % 2:
+                        submit(fm, action='delete', path='/%sr/' % name)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        for n, basepath in enumerate(basepaths):
+            fm = FileManager(basepath)
+            expected = set()
+            for t in range(n, 12, len(basepaths)):
+                for i in range(10):
+                    expected.add('t%d_%dc/sub' % (t, i))
+                    if not i % 2:
+                        expected.add('t%d_%dr/sub' % (t, i))
+            found = set()
+            for dirpath, dirnames, filenames in os.walk(basepath):
+                if not dirnames:
+                    found.add(os.path.relpath(dirpath, basepath))
+            self.assertEqual(found, expected)
+            self.assertEqual(fm.usage.get(), fm.usage.rebuild())
+
+
+class UploadTest(FileManagerTestCase):
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.fm = FileManager(self.basepath, extensions=['png', 'zip'])
+        output = io.BytesIO()
+        Image.new('RGB', (1, 1)).save(output, 'png')
+        self.png = output.getvalue()
+
+    def upload(self, *files):
+        return self.submit(
+            files=MultiValueDict({'ufile': list(files)}),
+            action='upload',
+            file_or_dir='file',
+        )
+
+    def test_rejected_upload_never_reaches_the_disk(self):
+        fake = SimpleUploadedFile('a.png', b'just some text')
+        real = SimpleUploadedFile('b.png', self.png)
+
+        messages = self.upload(fake, real)
+
+        self.assertEqual(messages, ['File type not allowed : a.png'])
+        self.assertEqual(os.listdir(self.basepath), ['b.png'])
+        self.assertEqual(self.fm.usage.bytes, len(self.png))
+
+    def test_same_name_uploads_never_overwrite_each_other(self):
+        self.write('a.png', self.png)
+        self.write('a.3.png', self.png)
+        results = []
+
+        def worker(n):
+            f = SimpleUploadedFile('a.png', self.png + bytes(bytearray([n])))
+            results.append(self.fm.save_upload(f, '/', 0))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        names = sorted(name for name, error in results)
+        self.assertEqual(names, sorted('a.%d.png' % n for n in range(4, 12)))
+        contents = set()
+        for name in names:
+            with open(os.path.join(self.basepath, name), 'rb') as f:
+                contents.add(f.read())
+        self.assertEqual(len(contents), 8)
+
+    def test_resumable_upload(self):
+        factory = RequestFactory()
+        response = self.fm.resumable_upload(factory.post(
+            '/?upload', {'name': 'big.png', 'size': len(self.png), 'path': '/'},
+        ))
+        self.assertEqual(response.status_code, 201)
+        upload = '/?upload=' + json.loads(response.content.decode())['id']
+
+        def patch(offset, data):
+            return self.fm.resumable_upload(factory.generic(
+                'PATCH', upload, data, HTTP_UPLOAD_OFFSET=str(offset),
+            ))
+
+        self.assertEqual(patch(0, self.png[:10])['Upload-Offset'], '10')
+        # a chunk sent again after a dropped connection
+        response = patch(0, self.png[:10])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '10')
+        self.assertEqual(self.fm.list_directory('/'), ([], []))
+        response = self.fm.resumable_upload(factory.get(upload))
+        offset = int(response['Upload-Offset'])
+        self.assertEqual(patch(offset, self.png[offset:]).status_code, 200)
+
+        response = self.fm.resumable_upload(factory.post(upload + '&finalize'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(os.listdir(self.basepath), ['big.png'])
+        with open(os.path.join(self.basepath, 'big.png'), 'rb') as f:
+            self.assertEqual(f.read(), self.png)
+        self.assertEqual(self.fm.usage.bytes, len(self.png))
+        self.assertEqual(self.fm.resumable_upload(factory.get(upload)).status_code, 404)
+
+    def test_slow_resumable_upload_does_not_block_others(self):
+        slow = UploadSession.create(self.basepath, 'a.png', '/', 10)
+        fast = UploadSession.create(self.basepath, 'b.png', '/', 10)
+        release = threading.Event()
+
+        class SlowStream(object):
+            def __init__(self):
+                self.chunks = [b'01234']
+
+            def read(self, size):
+                release.wait(5)
+                return self.chunks.pop() if self.chunks else b''
+        thread = threading.Thread(target=slow.append, args=(0, SlowStream()))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+
+        self.assertEqual(fast.append(0, io.BytesIO(b'0123456789')), 10)
+        self.assertTrue(thread.is_alive())
+
+    def test_resumable_upload_is_checked_on_creation(self):
+        response = self.fm.resumable_upload(RequestFactory().post(
+            '/?upload', {'name': 'big.png', 'size': 6*1024*1024, 'path': '/'},
+        ))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(self.basepath), [])
+
+    def test_resumable_upload_rejects_invalid_names(self):
+        response = self.fm.resumable_upload(RequestFactory().post(
+            '/?upload', {'name': '[a.png', 'size': 10, 'path': '/'},
+        ))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode()))
+
+    def test_unzip_validates_members(self):
+        with zipfile.ZipFile(self.write('a.zip', b''), 'w') as zf:
+            zf.writestr('d/ok.png', self.png)
+            zf.writestr('d/fake.png', b'text')
+            zf.writestr('../evil.png', self.png)
+        self.fm.usage.rebuild()
+
+        messages = self.submit(action='unzip', path='/a.zip', file_or_dir='file')
+
+        self.assertEqual(messages, [
+            'Extracted 1 of 3 files from a.zip',
+            'File in the zip is not allowed : d/fake.png (file type not allowed)',
+            'File in the zip is not allowed : ../evil.png (path outside of the folder)',
+        ])
+        self.assertEqual(sorted(os.listdir(self.basepath)), ['a.zip', 'd'])
+        self.assertEqual(os.listdir(os.path.join(self.basepath, 'd')), ['ok.png'])
+        self.assertEqual(self.fm.usage.get(), self.fm.usage.rebuild())
+
+        # extracted again over the files of the first time
+        self.submit(action='unzip', path='/a.zip', file_or_dir='file')
+
+        self.assertEqual(os.listdir(os.path.join(self.basepath, 'd')), ['ok.png'])
+        self.assertEqual(self.fm.usage.get(), self.fm.usage.rebuild())
+
+    def test_zip_bomb_is_rejected_before_writing(self):
+        with zipfile.ZipFile(self.write('a.zip', b''), 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('a.png', self.png + b'\0' * 1024 * 1024)
+        self.fm.usage.rebuild()
+
+        messages = self.submit(action='unzip', path='/a.zip', file_or_dir='file')
+
+        self.assertTrue(messages[0].startswith('ERROR : a.zip was rejected, it is compressed'))
+        self.assertEqual(os.listdir(self.basepath), ['a.zip'])
+
+    def test_unzip_over_quota_is_rejected(self):
+        self.fm.maxspace = 1
+        with zipfile.ZipFile(self.write('a.zip', b''), 'w') as zf:
+            zf.writestr('a.png', self.png)
+            zf.writestr('b.png', b'\0' * 1024)
+        self.fm.usage.rebuild()
+
+        messages = self.submit(action='unzip', path='/a.zip', file_or_dir='file')
+
+        self.assertTrue(messages[0].startswith('ERROR : a.zip was rejected, it expands to'))
+        self.assertEqual(os.listdir(self.basepath), ['a.zip'])
+
+    def test_unzip_of_a_broken_archive_fails_cleanly(self):
+        self.write('a.zip', b'not a zip file')
+        self.fm.usage.rebuild()
+
+        messages = self.submit(action='unzip', path='/a.zip', file_or_dir='file')
+
+        self.assertEqual(messages, ['ERROR : Could not unzip the file.'])
+        self.assertEqual(os.listdir(self.basepath), ['a.zip'])
+
+
+class MetricsTest(FileManagerTestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.metrics = []
+        metric_recorded.connect(self.receive)
+        self.addCleanup(metric_recorded.disconnect, self.receive)
+        server_timing = fm_settings.FILEMANAGER_SERVER_TIMING
+        self.addCleanup(setattr, fm_settings, 'FILEMANAGER_SERVER_TIMING', server_timing)
+        fm_settings.FILEMANAGER_SERVER_TIMING = True
+
+    def receive(self, sender, name, kind, value, labels, **kwargs):
+        self.metrics.append((name, kind, value, labels))
+
+    def test_actions_and_phases_are_measured(self):
+        self.write('a.txt', b'12345')
+        request = RequestFactory().post('/', {
+            'action': 'delete',
+            'path': '/a.txt',
+            'current_path': '/',
+            'file_or_dir': 'file',
+        })
+
+        response = self.fm.render(request, '')
+
+        phases = [p.split(';')[0] for p in response['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['action', 'usage', 'tree', 'template', 'total'])
+        recorded = dict(
+            ((name, labels.get('action')), value)
+            for name, kind, value, labels in self.metrics
+        )
+        self.assertEqual(recorded[('filemanager_action_bytes_total', 'delete')], 5)
+        self.assertEqual(recorded[('filemanager_action_files_total', 'delete')], 1)
+        self.assertIn(('filemanager_job_queue_depth', None), recorded)
+
+        text = prometheus_view(RequestFactory().get('/')).content.decode('utf-8')
+        self.assertIn('# TYPE filemanager_action_seconds summary', text)
+        self.assertIn('filemanager_actions_total{action="delete"}', text)
+
+
+class JobTest(FileManagerTestCase):
+    def setUp(self):
+        super(JobTest, self).setUp()
+        threshold = fm_settings.FILEMANAGER_JOB_THRESHOLD
+        self.addCleanup(setattr, fm_settings, 'FILEMANAGER_JOB_THRESHOLD', threshold)
+
+    def test_small_copy_runs_inline(self):
+        self.write('a/b.txt', b'12345')
+
+        self.assertEqual(self.submit(action='copy', path='/a/', current_path='/c/'), [])
+        self.assertEqual(self.fm.jobs, [])
+
+    def test_move_to_missing_folder_fails_cleanly(self):
+        self.write('a.txt', b'12345')
+
+        messages = self.submit(action='move', path='/a.txt', current_path='/nope/')
+
+        self.assertEqual(messages, ['File/folder couldn\'t be moved/copied.'])
+        self.assertTrue(os.path.exists(os.path.join(self.basepath, 'a.txt')))
+
+    def test_big_copy_runs_in_background(self):
+        fm_settings.FILEMANAGER_JOB_THRESHOLD = 1
+        self.write('a/b.txt', b'12345')
+        os.mkdir(os.path.join(self.basepath, 'c'))
+
+        messages = self.submit(action='copy', path='/a/', current_path='/c/')
+
+        self.assertEqual(messages, ['Running in the background : copy'])
+        job = job_queue().get(self.fm.jobs[0])
+        for i in range(100):
+            if job.finished:
+                break
+            time.sleep(0.05)
+        status = json.loads(self.fm.job_status(job.id).content.decode('utf-8'))
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual((status['bytes_done'], status['files_done']), (5, 1))
+        self.assertTrue(os.path.exists(os.path.join(self.basepath, 'c/a/b.txt')))
+        self.assertEqual(FileManager('/').job_status(job.id).status_code, 404)
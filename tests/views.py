@@ -1,8 +1,10 @@
 from django.conf import settings
 
 from filemanager import FileManager
+from filemanager.csrf import quick_upload_csrf
 
 
+@quick_upload_csrf
 def view(request, path):
     extensions = ['html', 'htm', 'zip', 'py', 'css', 'js', 'jpeg', 'jpg', 'png']
     fm = FileManager(settings.MEDIA_ROOT, extensions=extensions)